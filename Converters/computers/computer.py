@@ -1,58 +1,44 @@
-import pandas as pd
 import re
 import os
 import csv
 
+# === Regex patterns for title extraction ===
+TITLE_RE = re.compile(r'COL\s+title\s+VAL\s+(.*?)(?=\s+COL\s+|\s*$)')
+TAG_RE = re.compile(r'"|@(?:en|NL|fr)')
+
 def ditto_to_deepmatcher(input_file, output_file):
-    deepmatcher_data = []
     row_id = 0
 
-    # Read the lines (tab-separated)
-    with open(input_file, 'r', encoding='utf-8') as f:
-        lines = [line.strip().split('\t') for line in f.readlines()]
-
-    print(f"Processing {len(lines)} lines")
-
-    for parts in lines:
-        if not parts or len(parts) < 3:
-            print(f"Skipping invalid line: {parts}")
-            continue
-
-        left_text, right_text, label = parts[0], parts[1], parts[2]
-
-        title_left = extract_title(left_text)
-        title_right = extract_title(right_text)
-
-        record = {
-            'id': row_id,
-            'label': int(label.strip()),
-            'title_left': title_left,
-            'title_right': title_right
-        }
+    # Stream the lines (tab-separated) straight into the output CSV,
+    # quoting title fields (in case they contain commas)
+    with open(input_file, 'r', encoding='utf-8', buffering=1 << 20) as f, \
+            open(output_file, 'w', encoding='utf-8', newline='') as out:
+        writer = csv.writer(out, quoting=csv.QUOTE_NONNUMERIC, lineterminator='\n')
+        writer.writerow(['id', 'label', 'title_left', 'title_right'])
 
-        deepmatcher_data.append(record)
-        row_id += 1
+        for line in f:
+            parts = line.strip().split('\t')
+            if not parts or len(parts) < 3:
+                print(f"Skipping invalid line: {parts}")
+                continue
 
-    # Convert to DataFrame
-    df = pd.DataFrame(deepmatcher_data, columns=['id', 'label', 'title_left', 'title_right'])
+            left_text, right_text, label = parts[0], parts[1], parts[2]
 
-    # Save to CSV, quoting title fields (in case they contain commas)
-    df.to_csv(output_file, index=False, quoting=csv.QUOTE_NONNUMERIC)
+            label = int(label.strip())
+            writer.writerow([row_id, label, extract_title(left_text), extract_title(right_text)])
+            row_id += 1
 
-    print(f"Saved {len(df)} records to {output_file}")
-    return df
+    print(f"Saved {row_id} records to {output_file}")
+    return row_id
 
 def extract_title(entity_text):
     """
     Extract the 'COL title VAL ...' text, remove quotes, and return clean string.
     """
-    pattern = r'COL\s+title\s+VAL\s+(.*?)(?=\s+COL\s+|\s*$)'
-    match = re.search(pattern, entity_text)
+    match = TITLE_RE.search(entity_text)
     if match:
-        raw_val = match.group(1)
         # Remove ALL double quotes and language tags like @en
-        cleaned = raw_val.replace('"', '').replace('@en', '').replace('@NL', '').replace('@fr', '').strip()
-        return cleaned
+        return TAG_RE.sub('', match.group(1)).strip()
     return ""
 
 # Example usage
@@ -80,9 +66,11 @@ if __name__ == "__main__":
         sys.exit(1)
 
     try:
-        df = ditto_to_deepmatcher(input_file, output_file)
+        ditto_to_deepmatcher(input_file, output_file)
         print("\nPreview:")
-        print(df.head())
+        with open(output_file, 'r', encoding='utf-8') as out:
+            for _, line in zip(range(6), out):  # header + first 5 rows
+                print(line, end='')
     except Exception as e:
         print(f"Conversion error: {e}")
         sys.exit(1)
@@ -1,10 +1,10 @@
-import pandas as pd
 import re
 import csv
 import sys
 
 # === Regex pattern for COL/VAL fields ===
-FIELD_RE = re.compile(r'\bCOL\s+([A-Za-z0-9_]+)\s+VAL\b', re.IGNORECASE)
+FIELD_RE = re.compile(r'\bCOL\s+(?P<key>[A-Za-z0-9_]+)\s+VAL\b', re.IGNORECASE)
+YEAR_RE = re.compile(r'(\d{4})')
 
 def robust_parse_col_val(text: str) -> dict:
     """
@@ -14,51 +14,35 @@ def robust_parse_col_val(text: str) -> dict:
     if not text:
         return {}
 
-    matches = list(FIELD_RE.finditer(text))
+    # One split call yields [prefix, key1, val1, key2, val2, ...]
+    parts = FIELD_RE.split(text)
     record = {}
 
-    for i, m in enumerate(matches):
-        key = m.group(1).strip().lower()  # normalize key name
-        start = m.end()
-        end = matches[i + 1].start() if i + 1 < len(matches) else len(text)
-        val = text[start:end].strip()
+    for key, val in zip(parts[1::2], parts[2::2]):
+        key = key.lower()  # key group excludes whitespace; only case needs normalizing
         # Clean spacing, punctuation, and stray symbols
-        val = re.sub(r'\s+', ' ', val).strip(' |;,:')
+        val = ' '.join(val.split()).strip(' |;,:')
         record[key] = val
 
     return record
 
 
+def normalize_year(value: str) -> str:
+    """Return the first 4-digit run in value, or "" if there is none."""
+    match = YEAR_RE.search(value)
+    return match.group(1) if match else ""
+
+
 def parse_tabbed_file(lines, output_file, preferred_order=None):
     """
     Convert a tab-separated COL/VAL dataset to DeepMatcher-compatible CSV.
     Each line in input = "<left record>\t<right record>\t<label>"
+    Returns the number of records written.
     """
-    data = []
-    row_id = 0
+    parsed_rows = []
     all_fields = set()
 
-    # === First pass: find all field names ===
-    for raw in lines:
-        line = raw.strip()
-        if not line:
-            continue
-        parts = re.split(r'\t+', line)
-        if len(parts) != 3:
-            continue
-        left, right, _ = parts
-        all_fields.update(robust_parse_col_val(left).keys())
-        all_fields.update(robust_parse_col_val(right).keys())
-
-    # Order fields cleanly
-    if preferred_order:
-        preferred = [f for f in preferred_order if f in all_fields]
-        the_rest = sorted(f for f in all_fields if f not in preferred)
-        ordered_fields = preferred + the_rest
-    else:
-        ordered_fields = sorted(all_fields)
-
-    # === Second pass: build rows ===
+    # === Single pass: parse rows and collect field names ===
     for raw in lines:
         line = raw.strip()
         if not line:
@@ -78,28 +62,42 @@ def parse_tabbed_file(lines, output_file, preferred_order=None):
 
         left_fields = robust_parse_col_val(left_text)
         right_fields = robust_parse_col_val(right_text)
+        all_fields |= left_fields.keys() | right_fields.keys()
+        parsed_rows.append((label, left_fields, right_fields))
 
-        row = {'id': row_id, 'label': label}
-        for field in ordered_fields:
-            row[f'left_{field}']  = left_fields.get(field, "")
-            row[f'right_{field}'] = right_fields.get(field, "")
-
-        data.append(row)
-        row_id += 1
+    # Order fields cleanly
+    if preferred_order:
+        preferred = [f for f in preferred_order if f in all_fields]
+        the_rest = sorted(f for f in all_fields if f not in preferred)
+        ordered_fields = preferred + the_rest
+    else:
+        ordered_fields = sorted(all_fields)
 
-    # === Build DataFrame ===
-    df = pd.DataFrame(data)
+    header = ['id', 'label']
+    for field in ordered_fields:
+        header += [f'left_{field}', f'right_{field}']
 
-    # Optional: normalize 'year' fields to numeric 4-digit form
-    for side in ('left', 'right'):
-        col = f'{side}_year'
-        if col in df.columns:
-            df[col] = df[col].astype(str).str.extract(r'(\d{4})', expand=False).fillna("")
+    # === Build rows in header order ===
+    rows = []
+    for row_id, (label, left_fields, right_fields) in enumerate(parsed_rows):
+        row = [row_id, label]
+        for field in ordered_fields:
+            left_val = left_fields.get(field, "")
+            right_val = right_fields.get(field, "")
+            # Optional: normalize 'year' fields to numeric 4-digit form
+            if field == 'year':
+                left_val = normalize_year(left_val)
+                right_val = normalize_year(right_val)
+            row += [left_val, right_val]
+        rows.append(row)
 
     # === Save to CSV ===
-    df.to_csv(output_file, index=False, quoting=csv.QUOTE_NONNUMERIC)
-    print(f"✅ Saved {len(df)} records to {output_file}")
-    return df
+    with open(output_file, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_NONNUMERIC, lineterminator='\n')
+        writer.writerow(header)
+        writer.writerows(rows)
+    print(f"✅ Saved {len(rows)} records to {output_file}")
+    return len(rows)
 
 
 # === Entry point ===
@@ -107,12 +105,11 @@ if __name__ == "__main__":
     input_file = "test.txt"   # your COL/VAL dataset
     output_file = "test.csv"  # output DeepMatcher-compatible CSV
 
-    with open(input_file, "r", encoding="utf-8") as f:
-        lines = f.readlines()
-
-    # Field order for academic metadata
-    parse_tabbed_file(
-        lines,
-        output_file,
-        preferred_order=['title', 'authors', 'venue', 'year']
-    )
+    # Stream the file object; parse_tabbed_file makes a single pass over it
+    with open(input_file, "r", encoding="utf-8", buffering=1 << 20) as f:
+        # Field order for academic metadata
+        parse_tabbed_file(
+            f,
+            output_file,
+            preferred_order=['title', 'authors', 'venue', 'year']
+        )
@@ -1,42 +1,26 @@
-import pandas as pd
 import re
 import csv
 
+FIELD_RE = re.compile(r'COL\s+([^\s]+)\s+VAL')
+
 def robust_parse_col_val(text):
     """
     Improved COL/VAL parser to avoid splitting on fake 'COL' inside values.
-    Uses index-based slicing instead of greedy regex.
+    Splits on the COL/VAL markers instead of using a greedy regex.
     """
-    pattern = re.compile(r'COL\s+([^\s]+)\s+VAL')
-    matches = list(pattern.finditer(text))
+    parts = FIELD_RE.split(text)  # [prefix, key1, val1, key2, val2, ...]
     record = {}
 
-    for i in range(len(matches)):
-        key = matches[i].group(1).strip()
-        start = matches[i].end()
-        end = matches[i + 1].start() if i + 1 < len(matches) else len(text)
-        val = text[start:end].strip()
-        record[key] = val
+    for key, val in zip(parts[1::2], parts[2::2]):
+        record[key.strip()] = val.strip()
 
     return record
 
 def parse_tabbed_file(lines, output_file):
-    data = []
-    row_id = 0
+    parsed_rows = []
     all_fields = set()
 
-    # First pass: collect all unique field names
-    for line in lines:
-        parts = line.strip().split('\t')
-        if len(parts) != 3:
-            continue
-        left, right, _ = parts
-        all_fields.update(robust_parse_col_val(left).keys())
-        all_fields.update(robust_parse_col_val(right).keys())
-
-    all_fields = sorted(all_fields)
-
-    # Second pass: extract structured data
+    # Single pass: parse rows and collect all unique field names
     for line in lines:
         parts = line.strip().split('\t')
         if len(parts) != 3:
@@ -52,30 +36,37 @@ def parse_tabbed_file(lines, output_file):
 
         left_fields = robust_parse_col_val(left_text)
         right_fields = robust_parse_col_val(right_text)
+        all_fields |= left_fields.keys() | right_fields.keys()
+        parsed_rows.append((label, left_fields, right_fields))
+
+    all_fields = sorted(all_fields)
+
+    header = ['id', 'label']
+    for field in all_fields:
+        header += [f'left_{field}', f'right_{field}']
 
-        row = {
-            'id': row_id,
-            'label': label
-        }
+    # Build rows in header order from the parsed records
+    rows = []
+    for row_id, (label, left_fields, right_fields) in enumerate(parsed_rows):
+        row = [row_id, label]
 
         for field in all_fields:
-            row[f'left_{field}'] = left_fields.get(field, "")
-            row[f'right_{field}'] = right_fields.get(field, "")
+            row += [left_fields.get(field, ""), right_fields.get(field, "")]
 
-        data.append(row)
-        row_id += 1
+        rows.append(row)
 
-    df = pd.DataFrame(data)
-    df.to_csv(output_file, index=False, quoting=csv.QUOTE_NONNUMERIC)
-    print(f"✅ Saved {len(df)} records to {output_file}")
-    return df
+    with open(output_file, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_NONNUMERIC, lineterminator='\n')
+        writer.writerow(header)
+        writer.writerows(rows)
+    print(f"✅ Saved {len(rows)} records to {output_file}")
+    return len(rows)
 
 # === Entry point ===
 if __name__ == "__main__":
     input_file = "test.txt"
     output_file = "test_1.csv"
 
-    with open(input_file, "r", encoding="utf-8") as f:
-        lines = f.readlines()
-
-    parse_tabbed_file(lines, output_file)
+    # Stream the file object; parse_tabbed_file makes a single pass over it
+    with open(input_file, "r", encoding="utf-8", buffering=1 << 20) as f:
+        parse_tabbed_file(f, output_file)
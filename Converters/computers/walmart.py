@@ -1,28 +1,25 @@
-import pandas as pd
 import re
 import csv
 import sys
 
-FIELD_RE = re.compile(r'\bCOL\s+([A-Za-z0-9_]+)\s+VAL\b', re.IGNORECASE)
+FIELD_RE = re.compile(r'\bCOL\s+(?P<key>[A-Za-z0-9_]+)\s+VAL\b', re.IGNORECASE)
 
 def robust_parse_col_val(text: str) -> dict:
     """
     Parse 'COL <key> VAL <value>' segments without being confused by 'COL' inside values.
-    Uses explicit boundary matches and index slicing between successive COL/VAL markers.
+    Splits on explicit boundary matches, so each value is the text between successive COL/VAL markers.
     """
     if not text:
         return {}
 
-    matches = list(FIELD_RE.finditer(text))
+    # one split call yields [prefix, key1, val1, key2, val2, ...]
+    parts = FIELD_RE.split(text)
     record = {}
 
-    for i, m in enumerate(matches):
-        key = m.group(1).strip().lower()  # normalize keys
-        start = m.end()
-        end = matches[i + 1].start() if i + 1 < len(matches) else len(text)
-        val = text[start:end].strip()
+    for key, val in zip(parts[1::2], parts[2::2]):
+        key = key.lower()  # key group has no surrounding whitespace; normalize case
         # collapse internal whitespace; trim stray separators
-        val = re.sub(r'\s+', ' ', val).strip(' |;,:')
+        val = ' '.join(val.split()).strip(' |;,:')
         record[key] = val
 
     return record
@@ -31,39 +28,18 @@ def parse_tabbed_file(lines, output_file, preferred_order=None):
     """
     lines: iterable of strings. Each line = "<left>\t<right>\t<label>"
     preferred_order: an optional ordered list of expected fields to pin column order (e.g., ['title','category','brand','modelno','price'])
+    Returns the number of records written.
     """
-    data = []
-    row_id = 0
+    parsed_rows = []
     all_fields = set()
 
-    # First pass: collect all unique field names
+    # Single pass: parse rows and collect all unique field names
     for raw in lines:
         line = raw.strip()
         if not line:
             continue
-        parts = re.split(r'\t+', line)  # tolerate multiple tabs
-        if len(parts) != 3:
-            # silently skip in pass 1
-            continue
-        left, right, _ = parts
-        all_fields.update(robust_parse_col_val(left).keys())
-        all_fields.update(robust_parse_col_val(right).keys())
-
-    # lock a stable, sensible field order
-    if preferred_order:
-        preferred = [f for f in preferred_order if f in all_fields]
-        the_rest = sorted(f for f in all_fields if f not in preferred)
-        ordered_fields = preferred + the_rest
-    else:
-        ordered_fields = sorted(all_fields)
 
-    # Second pass: build rows
-    for raw in lines:
-        line = raw.strip()
-        if not line:
-            continue
-
-        parts = re.split(r'\t+', line)
+        parts = re.split(r'\t+', line)  # tolerate multiple tabs
         if len(parts) != 3:
             print(f"Skipping malformed line (not 3 tab-separated parts): {line[:120]}...", file=sys.stderr)
             continue
@@ -77,30 +53,39 @@ def parse_tabbed_file(lines, output_file, preferred_order=None):
 
         left_fields = robust_parse_col_val(left_text)
         right_fields = robust_parse_col_val(right_text)
+        all_fields |= left_fields.keys() | right_fields.keys()
+        parsed_rows.append((label, left_fields, right_fields))
 
-        row = {'id': row_id, 'label': label}
-        for field in ordered_fields:
-            row[f'left_{field}']  = left_fields.get(field, "")
-            row[f'right_{field}'] = right_fields.get(field, "")
+    # lock a stable, sensible field order
+    if preferred_order:
+        preferred = [f for f in preferred_order if f in all_fields]
+        the_rest = sorted(f for f in all_fields if f not in preferred)
+        ordered_fields = preferred + the_rest
+    else:
+        ordered_fields = sorted(all_fields)
 
-        data.append(row)
-        row_id += 1
+    header = ['id', 'label']
+    for field in ordered_fields:
+        header += [f'left_{field}', f'right_{field}']
 
-    df = pd.DataFrame(data)
+    # Build rows in header order from the parsed records
+    rows = []
+    for row_id, (label, left_fields, right_fields) in enumerate(parsed_rows):
+        row = [row_id, label]
+        for field in ordered_fields:
+            row += [left_fields.get(field, ""), right_fields.get(field, "")]
+        rows.append(row)
 
-    # If you want numeric price inference, uncomment next 6 lines
-    # for side in ('left', 'right'):
-    #     col = f'{side}_price'
-    #     if col in df.columns:
-    #         df[col] = (
-    #             df[col].str.extract(r'([0-9]+(?:\.[0-9]+)?)', expand=False)
-    #                   .astype(float, errors='ignore')
-    #         )
+    # If you want numeric price inference, map the price values through
+    # re.search(r'([0-9]+(?:\.[0-9]+)?)', val) and float() while building rows
 
-    df.to_csv(output_file, index=False, quoting=csv.QUOTE_NONNUMERIC)
-    #df.to_csv(output_file, index=False, quoting=csv.QUOTE_NONE, escapechar='\\')
-    print(f"✅ Saved {len(df)} records to {output_file}")
-    return df
+    with open(output_file, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_NONNUMERIC, lineterminator='\n')
+        #writer = csv.writer(f, quoting=csv.QUOTE_NONE, escapechar='\\', lineterminator='\n')
+        writer.writerow(header)
+        writer.writerows(rows)
+    print(f"✅ Saved {len(rows)} records to {output_file}")
+    return len(rows)
 
 # === Entry point ===
 if __name__ == "__main__":
@@ -108,8 +93,7 @@ if __name__ == "__main__":
     input_file = "train.txt"
     output_file = "train.csv"
 
-    with open(input_file, "r", encoding="utf-8") as f:
-        lines = f.readlines()
-
-    # Pin common field order so CSV columns look tidy
-    parse_tabbed_file(lines, output_file, preferred_order=['title','category','brand','modelno','price'])
+    # Stream the file object; parse_tabbed_file makes a single pass over it
+    with open(input_file, "r", encoding="utf-8", buffering=1 << 20) as f:
+        # Pin common field order so CSV columns look tidy
+        parse_tabbed_file(f, output_file, preferred_order=['title','category','brand','modelno','price'])
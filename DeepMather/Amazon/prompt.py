@@ -1,11 +1,21 @@
+import asyncio
+import csv
+import hashlib
+import io
+import logging
+import sqlite3
+import sys
 import pandas as pd
 import ollama
 from tqdm import tqdm
 import re
 import json
+import orjson
 from textwrap import dedent
 import os
-from typing import Dict, Any, Tuple, Optional
+from contextlib import AsyncExitStack
+from itertools import groupby, islice
+from typing import Dict, Any, List, Set, Tuple, Optional
 
 # Expected output keys for each side
 EXPECTED_KEYS = [
@@ -14,10 +24,93 @@ EXPECTED_KEYS = [
     "price"
 ]
 
+# Per-row diagnostics; the per-pair dumps are DEBUG (run with --verbose to see them)
+log = logging.getLogger(__name__)
+
+# Price cleanup: placeholder strings and currency symbols / thousands separators
+PRICE_NULLS = frozenset({"", "n/a", "na", "none", "null", "unknown"})
+CURRENCY_RE = re.compile(r"[,$]")
+
+# Parses the first complete JSON value in a reply and ignores whatever follows it
+JSON_DECODER = json.JSONDecoder()
+
+
+class PromptCache:
+    """
+    Raw LLM replies keyed by a hash of everything sent to the model.
+    Kept in memory and, when a path is given, persisted to SQLite so
+    repeated pairs across splits and reruns skip the LLM entirely.
+    """
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self._mem: Dict[str, str] = {}
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, isolation_level=None)
+            self._db.execute("CREATE TABLE IF NOT EXISTS replies (key TEXT PRIMARY KEY, content TEXT)")
+
+    @staticmethod
+    def key(*parts: Any) -> str:
+        return hashlib.sha256(orjson.dumps(parts, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        if key in self._mem:
+            return self._mem[key]
+        if self._db is not None:
+            row = self._db.execute("SELECT content FROM replies WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self._mem[key] = row[0]
+                return row[0]
+        return None
+
+    def set(self, key: str, content: str) -> None:
+        self._mem[key] = content
+        if self._db is not None:
+            self._db.execute("INSERT OR REPLACE INTO replies (key, content) VALUES (?, ?)", (key, content))
+
 
 class OllamaFeatureExtractor:
-    def __init__(self, model_name: str = "mistral-nemo:latest") -> None:
+    def __init__(
+        self,
+        model_name: str = "mistral-nemo:latest",
+        max_concurrency: Optional[int] = None,
+        batch_size: int = 4,
+        chunk_size: int = 1024,
+        use_cache: bool = True,
+        cache_path: Optional[str] = ".llm_cache.sqlite",
+        host: Optional[str] = None,
+        timeout: float = 300,
+        replicas: Optional[List[str]] = None,
+    ) -> None:
+        # Default Ollama tags such as mistral-nemo:latest are already 4-bit (Q4_0);
+        # pull an explicit quant (e.g. `ollama pull llama3.1:8b-instruct-q4_K_M`)
+        # and pass it here to try another model at the same memory footprint.
         self.llm_model = model_name
+        # Server address (None falls back to OLLAMA_HOST) and per-request timeout
+        self.host = host
+        self.timeout = timeout
+        # Several `ollama serve` replicas (e.g. one per GPU, or CPU hosts) can share
+        # the load: batches are dealt round-robin across them. Also read from a
+        # comma-separated OLLAMA_HOSTS; defaults to the single `host`.
+        if replicas is None:
+            replicas = [h.strip() for h in os.environ.get("OLLAMA_HOSTS", "").split(",") if h.strip()]
+        self.hosts: List[Optional[str]] = list(replicas) or [host]
+        # Replies are cached by exact request (model, options, messages); pass
+        # use_cache=False (or --no-cache on the command line) for ablations
+        self.cache = PromptCache(cache_path) if use_cache else None
+        # Consecutive same-label pairs sent per LLM call; 1 disables batching
+        self.batch_size = max(1, batch_size)
+        # Input rows read per pd.read_csv chunk; the next chunk is parsed while
+        # the current one is with the LLM, so memory stays bounded
+        self.chunk_size = chunk_size
+        # In-flight requests per replica. Match the server's parallel slots: start
+        # `ollama serve` with OLLAMA_NUM_PARALLEL=N (and OLLAMA_MAX_LOADED_MODELS=1
+        # so all slots share one model); the same variable is read here by default.
+        if max_concurrency is None:
+            max_concurrency = int(os.environ.get("OLLAMA_NUM_PARALLEL", 8))
+        self.max_concurrency = max_concurrency
+        # Pairs answered without the LLM in the current pass
+        self.fast_path_hits = 0
 
     # -------------------- Coercion & Validation --------------------
     def _coerce_price(self, value: Any) -> Any:
@@ -25,15 +118,20 @@ class OllamaFeatureExtractor:
         if value is None:
             return "unknown"
         if isinstance(value, (int, float)):
-            return float(f"{float(value):.2f}")
+            return round(float(value), 2)
         if isinstance(value, str):
             v = value.strip().lower()
-            if v in {"", "n/a", "na", "none", "null", "unknown"}:
+            if v in PRICE_NULLS:
                 return "unknown"
+            try:
+                # Fast path: already a plain number
+                return round(float(v), 2)
+            except ValueError:
+                pass
             # Remove currency symbols and commas
-            v = re.sub(r"[,$]", "", v)
+            v = CURRENCY_RE.sub("", v)
             try:
-                return float(f"{float(v):.2f}")
+                return round(float(v), 2)
             except Exception:
                 return "unknown"
         return "unknown"
@@ -47,138 +145,222 @@ class OllamaFeatureExtractor:
         out["price"] = self._coerce_price(response.get("price", "unknown"))
         return out
 
-    def _extract_json(self, text: str) -> Dict[str, Any]:
-        """Robustly extract a single JSON object from the model output."""
-        # Strip code fences if present
+    def _extract_json(self, text: str) -> Any:
+        """Robustly extract a single JSON object (or batch array) from the model output."""
+        # Strip code fences if present (plain slicing; the opening line may carry a language tag)
         if text.startswith("```"):
-            text = re.sub(r"^```[a-zA-Z]*\n?", "", text)
-            text = re.sub(r"```$", "", text).strip()
-        # Heuristic: take the outermost JSON object
+            nl = text.find("\n")
+            text = text[nl + 1:] if nl != -1 else text[3:]
+            if text.endswith("```"):
+                text = text[:-3]
+            text = text.strip()
+        # Take the JSON array or object that opens first and stop at its end,
+        # so trailing chatter is never scanned
         start = text.find("{")
-        end = text.rfind("}")
+        array_start = text.find("[")
+        is_array = array_start != -1 and (start == -1 or array_start < start)
+        if is_array:
+            start = array_start
+        if start != -1:
+            try:
+                return JSON_DECODER.raw_decode(text, start)[0]
+            except ValueError:
+                pass
+        # Fallback heuristic: take the outermost JSON array or object
+        end = text.rfind("]" if is_array else "}")
         if start != -1 and end != -1 and end > start:
             text = text[start : end + 1]
-        return json.loads(text)
+        # orjson.JSONDecodeError subclasses json.JSONDecodeError, so callers' handlers still apply
+        return orjson.loads(text)
+
+    def _is_trivial(self, record: Dict[str, Any]) -> bool:
+        """True when a record has neither a title nor a manufacturer."""
+        for key in ("title", "manufacturer"):
+            value = record.get(key)
+            if pd.notna(value) and str(value).strip():
+                return False
+        return True
 
     # -------------------- LLM prompts (two variants) --------------------
-    def _build_prompt_match(self, left: Dict[str, Any], right: Dict[str, Any]) -> str:
+    # Each prompt carries one or more pairs; with several, the shared rules are
+    # sent once and the model answers with a "results" array in pair order.
+    # The rule text is static, so it is dedented once at class load and only the
+    # response-shape lines and the record blocks are filled in per call.
+    # Rules go in the system message and only the records in the user message,
+    # so consecutive requests share a byte-identical prefix that the server can
+    # keep in its KV cache instead of re-evaluating it.
+    def _return_instruction(self, n: int) -> str:
+        if n == 1:
+            return 'Return a SINGLE valid JSON object with exactly two top-level keys: "left" and "right".'
+        # format="json" only admits a top-level object, so the batch array is wrapped
+        return (
+            'Return a SINGLE valid JSON object with exactly one top-level key: "results". '
+            f'"results" is an array of exactly {n} objects, one per numbered pair [1]..[{n}], in order. '
+            'Each object in "results" has exactly two keys: "left" and "right".'
+        )
+
+    def _output_instruction(self, n: int) -> str:
+        if n == 1:
+            return "Return exactly one JSON object."
+        return f'Return exactly one JSON object whose "results" array holds {n} objects, in pair order.'
+
+    def _format_records(self, pairs: List[Tuple[Dict[str, Any], Dict[str, Any]]]) -> str:
+        def _pair(left: Dict[str, Any], right: Dict[str, Any]) -> str:
+            return (
+                f"Left record input:\n{orjson.dumps(left).decode()}\n\n"
+                f"Right record input:\n{orjson.dumps(right).decode()}\n"
+            )
+
+        if len(pairs) == 1:
+            return "Now process this record:\n\n" + _pair(*pairs[0])
+        blocks = [f"\n[{i}]\n" + _pair(left, right) for i, (left, right) in enumerate(pairs, 1)]
+        return f"Now process these {len(pairs)} record pairs:\n" + "".join(blocks)
+
+    _MATCH_TEMPLATE = dedent("""
+    You are a product-normalization expert for software titles. Normalize and ALIGN two Amazon software/product records for DeepMatcher.
+
+    {return_instruction}
+    Each side must follow this schema:
+      • "title" (string)
+      • "manufacturer" (string)
+      • "price" (float or "unknown")
+
+    ALIGNMENT & NORMALIZATION FOR MATCHED PAIRS (label = 1)
+    - Aggressively remove noise:
+      • Delete alphanumeric SKUs / catalog codes (e.g., "19600061dm", "SF9006").
+      • Remove brackets/parentheses that ONLY specify platform/media (e.g., "[Mac]", "(Win 95/98/ME)", "(DVD)").
+      • Trim generic trailer phrases (case-insensitive; stop at first match):
+        "Full Version of .* Software" · ".* Production Software" · "Sound Editing S/?W" ·
+        "Photo Editing Software for Windows" · "Complete (Package|Product)" · "Standard English PC" ·
+        "Scientific Brain Training" · "Music Production" · "Qualification" · "Contact Management .*" ·
+        "No Limit Texas Hold 'Em" · similar marketing tails.
+    - Expand abbreviations/spellings:
+      CS1/2/3 → Creative Suite 1/2/3 · CAL → Client Access License · Svr → Server ·
+      Upg → Upgrade · OEM → OEM · AV → Anti-Virus · S/W → Software · Win → Windows ·
+      Propack → Pro Pack · keep “Host Only”.
+    - PRESERVE SPECIFICITY:
+      • Keep version/edition/license tokens exactly (CS3, XI, X3, 11.0, 7.3, 2007, Professional, Home, Standard, Upgrade, 3-User, Host Only, Boxed).
+      • If a version/edition appears on only one side and there is NO conflicting version/edition on the other side, COPY it so both sides align to the most specific shared product.
+    - Casing & whitespace: Title Case; collapse multiple spaces; dedupe consecutive duplicate words.
+    - Manufacturer canonicalization: shortest unambiguous form (e.g., “Adobe Systems Inc” → “Adobe”; “Microsoft Corporation” → “Microsoft”); drop Inc., Ltd., Corp., Software unless needed to disambiguate.
+    - Missing values: empty title/manufacturer → ""; price: valid number → float with two decimals; else "unknown".
+    - NEVER invent prices. Do not copy a price from one side to the other.
+
+    OUTPUT RULES — STRICT
+    - {output_instruction}
+    - No code fences/markdown/comments/logs.
+    - Keys must be exactly: left.title, left.manufacturer, left.price, right.title, right.manufacturer, right.price.
+    - Price must be float (two decimals) or "unknown".
+
+    """)
+
+    def _build_prompt_match(self, pairs: List[Tuple[Dict[str, Any], Dict[str, Any]]]) -> Tuple[str, str]:
         """Prompt A — Label = 1 (MATCH): strong alignment-oriented normalization."""
-        return dedent(f"""
-        You are a product-normalization expert for software titles. Normalize and ALIGN two Amazon software/product records for DeepMatcher.
-
-        Return a SINGLE valid JSON object with exactly two top-level keys: "left" and "right".
-        Each side must follow this schema:
-          • "title" (string)
-          • "manufacturer" (string)
-          • "price" (float or "unknown")
-
-        ALIGNMENT & NORMALIZATION FOR MATCHED PAIRS (label = 1)
-        - Aggressively remove noise:
-          • Delete alphanumeric SKUs / catalog codes (e.g., "19600061dm", "SF9006").
-          • Remove brackets/parentheses that ONLY specify platform/media (e.g., "[Mac]", "(Win 95/98/ME)", "(DVD)").
-          • Trim generic trailer phrases (case-insensitive; stop at first match):
-            "Full Version of .* Software" · ".* Production Software" · "Sound Editing S/?W" ·
-            "Photo Editing Software for Windows" · "Complete (Package|Product)" · "Standard English PC" ·
-            "Scientific Brain Training" · "Music Production" · "Qualification" · "Contact Management .*" ·
-            "No Limit Texas Hold 'Em" · similar marketing tails.
-        - Expand abbreviations/spellings:
-          CS1/2/3 → Creative Suite 1/2/3 · CAL → Client Access License · Svr → Server ·
-          Upg → Upgrade · OEM → OEM · AV → Anti-Virus · S/W → Software · Win → Windows ·
-          Propack → Pro Pack · keep “Host Only”.
-        - PRESERVE SPECIFICITY:
-          • Keep version/edition/license tokens exactly (CS3, XI, X3, 11.0, 7.3, 2007, Professional, Home, Standard, Upgrade, 3-User, Host Only, Boxed).
-          • If a version/edition appears on only one side and there is NO conflicting version/edition on the other side, COPY it so both sides align to the most specific shared product.
-        - Casing & whitespace: Title Case; collapse multiple spaces; dedupe consecutive duplicate words.
-        - Manufacturer canonicalization: shortest unambiguous form (e.g., “Adobe Systems Inc” → “Adobe”; “Microsoft Corporation” → “Microsoft”); drop Inc., Ltd., Corp., Software unless needed to disambiguate.
-        - Missing values: empty title/manufacturer → ""; price: valid number → float with two decimals; else "unknown".
-        - NEVER invent prices. Do not copy a price from one side to the other.
-
-        OUTPUT RULES — STRICT
-        - Return exactly one JSON object.
-        - No code fences/markdown/comments/logs.
-        - Keys must be exactly: left.title, left.manufacturer, left.price, right.title, right.manufacturer, right.price.
-        - Price must be float (two decimals) or "unknown".
-
-        Now process this record:
-        
-        Left record input:
-        {json.dumps(left, ensure_ascii=False, indent=2)}
-
-        Right record input:
-        {json.dumps(right, ensure_ascii=False, indent=2)}
-        """)
-
-    def _build_prompt_nonmatch(self, left: Dict[str, Any], right: Dict[str, Any]) -> str:
+        n = len(pairs)
+        return self._MATCH_TEMPLATE.format(
+            return_instruction=self._return_instruction(n),
+            output_instruction=self._output_instruction(n),
+        ), self._format_records(pairs)
+
+    _NONMATCH_TEMPLATE = dedent("""
+    You are a product-normalization expert for software titles. Lightly CLEAN two Amazon software/product records for DeepMatcher WITHOUT aligning them. Preserve discriminative tokens and platform/media cues.
+
+    {return_instruction}
+    Each side must follow this schema:
+      • "title" (string)
+      • "manufacturer" (string)
+      • "price" (float or "unknown")
+
+    LIGHT NORMALIZATION FOR NON-MATCHED PAIRS (label = 0)
+    - DO NOT remove platform/media tags in brackets/parentheses (e.g., "[Mac]", "(Windows)", "(DVD)").
+    - DO NOT trim generic trailer phrases; keep marketing tails and qualifiers.
+    - DO NOT delete alphanumeric SKUs / catalog codes; keep them.
+    - DO NOT propagate or copy version/edition/license tokens across sides.
+    - Abbreviation expansion: avoid expanding (Win, CS3, Pro, etc.) to keep original distinctions, except simple punctuation/casing fixes.
+    - Preserve specificity: keep all version/edition/license tokens exactly as given.
+    - Casing & whitespace: convert to Title Case; collapse multiple spaces; remove consecutive duplicate words.
+    - Manufacturer canonicalization: shorten obvious suffixes (Inc., Ltd., Corp., Software) when unambiguous; do NOT force two different brands to match.
+    - Missing values: empty title/manufacturer → ""; price: valid number → float with two decimals; else "unknown".
+    - NEVER invent prices.
+
+
+    OUTPUT RULES — STRICT
+    - {output_instruction}
+    - No code fences/markdown/comments/logs.
+    - Keys must be exactly: left.title, left.manufacturer, left.price, right.title, right.manufacturer, right.price.
+    - Price must be float (two decimals) or "unknown".
+
+    """)
+
+    def _build_prompt_nonmatch(self, pairs: List[Tuple[Dict[str, Any], Dict[str, Any]]]) -> Tuple[str, str]:
         """Prompt B — Label = 0 (NON-MATCH): light, conservative cleanup without alignment."""
-        return dedent(f"""
-        You are a product-normalization expert for software titles. Lightly CLEAN two Amazon software/product records for DeepMatcher WITHOUT aligning them. Preserve discriminative tokens and platform/media cues.
-
-        Return a SINGLE valid JSON object with exactly two top-level keys: "left" and "right".
-        Each side must follow this schema:
-          • "title" (string)
-          • "manufacturer" (string)
-          • "price" (float or "unknown")
-
-        LIGHT NORMALIZATION FOR NON-MATCHED PAIRS (label = 0)
-        - DO NOT remove platform/media tags in brackets/parentheses (e.g., "[Mac]", "(Windows)", "(DVD)").
-        - DO NOT trim generic trailer phrases; keep marketing tails and qualifiers.
-        - DO NOT delete alphanumeric SKUs / catalog codes; keep them.
-        - DO NOT propagate or copy version/edition/license tokens across sides.
-        - Abbreviation expansion: avoid expanding (Win, CS3, Pro, etc.) to keep original distinctions, except simple punctuation/casing fixes.
-        - Preserve specificity: keep all version/edition/license tokens exactly as given.
-        - Casing & whitespace: convert to Title Case; collapse multiple spaces; remove consecutive duplicate words.
-        - Manufacturer canonicalization: shorten obvious suffixes (Inc., Ltd., Corp., Software) when unambiguous; do NOT force two different brands to match.
-        - Missing values: empty title/manufacturer → ""; price: valid number → float with two decimals; else "unknown".
-        - NEVER invent prices.
-
-
-        OUTPUT RULES — STRICT
-        - Return exactly one JSON object.
-        - No code fences/markdown/comments/logs.
-        - Keys must be exactly: left.title, left.manufacturer, left.price, right.title, right.manufacturer, right.price.
-        - Price must be float (two decimals) or "unknown".
-
-        Now process this record:
-        
-        Left record input:
-        {json.dumps(left, ensure_ascii=False, indent=2)}
-
-        Right record input:
-        {json.dumps(right, ensure_ascii=False, indent=2)}
-        """)
+        n = len(pairs)
+        return self._NONMATCH_TEMPLATE.format(
+            return_instruction=self._return_instruction(n),
+            output_instruction=self._output_instruction(n),
+        ), self._format_records(pairs)
+
+    def _build_prompt(
+        self, pairs: List[Tuple[Dict[str, Any], Dict[str, Any]]], label: Optional[int]
+    ) -> Tuple[str, str]:
+        """Return (instructions, records) for the system and user messages."""
+        if label == 1:
+            return self._build_prompt_match(pairs)
+        return self._build_prompt_nonmatch(pairs)
 
     # -------------------- LLM call --------------------
-    def _chat_json(self, prompt: str) -> Dict[str, Any]:
-        response = ollama.chat(
-            model=self.llm_model,
-            options={"temperature": 0.0, "num_predict": 1024},
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "You are a careful information extractor. Output only valid JSON. "
-                        "Do not include explanations, markdown fences, comments, or extra text. "
-                        "Return exactly one JSON object conforming to the requested schema."
-                    ),
-                },
-                {"role": "user", "content": prompt},
-            ],
-        )
+    async def _chat_json(
+        self, client: ollama.AsyncClient, instructions: str, records: str, n_pairs: int = 1
+    ) -> Any:
+        # One left/right object is ~60-150 tokens, so 256 per pair bounds runaway
+        # generations without truncating real answers.
+        # A fixed num_ctx keeps every request on the same loaded context.
+        options = {"temperature": 0.0, "num_predict": 256 * n_pairs, "num_ctx": 4096}
+        messages = [
+            {
+                "role": "system",
+                "content": (
+                    "You are a careful information extractor. Output only valid JSON. "
+                    "Do not include explanations, markdown fences, comments, or extra text. "
+                    "Return exactly one JSON object conforming to the requested schema.\n"
+                    + instructions
+                ),
+            },
+            {"role": "user", "content": records},
+        ]
+
+        cache_key = None
+        if self.cache is not None:
+            cache_key = PromptCache.key(self.llm_model, options, messages)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return self._parse_reply(cached)
+
+        # format="json" makes the server constrain decoding to a valid JSON object
+        response = await client.chat(model=self.llm_model, format="json", options=options, messages=messages)
         content = response["message"]["content"].strip()
         try:
-            return self._extract_json(content)
+            parsed = self._parse_reply(content)
         except json.JSONDecodeError as jde:
-            # Try a second pass by removing everything before first '{' and after last '}'
-            try:
-                return self._extract_json(content)
-            except Exception:
-                print(f"❌ JSON decode error: {jde}")
-                print("⚠️ Content that failed parsing:", content)
-                raise
+            log.warning("❌ JSON decode error: %s", jde)
+            log.warning("⚠️ Content that failed parsing: %s", content)
+            raise
+        # Only replies that parse are cached, so failures are retried next run
+        if cache_key is not None:
+            self.cache.set(cache_key, content)
+        return parsed
+
+    def _parse_reply(self, content: str) -> Any:
+        """Constrained replies are plain JSON; _extract_json stays as defense in depth."""
+        try:
+            return orjson.loads(content)
+        except orjson.JSONDecodeError:
+            return self._extract_json(content)
 
     # -------------------- Main extraction API --------------------
-    def extract_pair_standardized_attributes(
+    async def extract_pair_standardized_attributes(
         self,
+        client: ollama.AsyncClient,
         left_record: Dict[str, Any],
         right_record: Dict[str, Any],
         label: Optional[int] = None,
@@ -189,70 +371,251 @@ class OllamaFeatureExtractor:
           - label == 0 → light, conservative cleanup (non-match)
           - label is None → default to non-match prompt (safer at inference)
         """
-        if label == 1:
-            prompt = self._build_prompt_match(left_record, right_record)
-        else:
-            prompt = self._build_prompt_nonmatch(left_record, right_record)
+        instructions, records = self._build_prompt([(left_record, right_record)], label)
 
         try:
-            parsed = self._chat_json(prompt)
+            parsed = await self._chat_json(client, instructions, records)
             left_out = self.normalize_llm_output(parsed.get("left", {}))
             right_out = self.normalize_llm_output(parsed.get("right", {}))
-            print("left :",left_out,"---- right:",right_out)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("left : %s ---- right: %s", left_out, right_out)
             return left_out, right_out
         except Exception as e:
-            print(f"❌ Extraction error: {e}")
+            log.warning("❌ Extraction error: %s", e)
             # Fallback to minimally cleaned original inputs
             return self.normalize_llm_output(left_record), self.normalize_llm_output(right_record)
 
-    # -------------------- Dataset utilities --------------------
-    def split_record(self, row: Dict[str, Any], side: str) -> Dict[str, Any]:
-        return {col[len(f"{side}_"):]: row[col] for col in row if col.startswith(f"{side}_")}
-
-    def process_dataset(self, input_csv: str, output_csv: str) -> None:
-        print(f"📄 Reading data from {input_csv}...")
-        df = pd.read_csv(input_csv)
-        all_rows = []
-
-        for _, row in tqdm(df.iterrows(), total=len(df)):
-            row_dict = row.to_dict()
-            left_input = self.split_record(row_dict, "left")
-            right_input = self.split_record(row_dict, "right")
-
-            raw_label = row_dict.get("label", None)
-            try:
-                label_val: Optional[int] = int(raw_label) if pd.notna(raw_label) else None
-            except Exception:
-                label_val = None
-
-            left_cleaned, right_cleaned = self.extract_pair_standardized_attributes(
-                left_input, right_input, label=label_val
-            )
+    async def extract_batch_standardized_attributes(
+        self,
+        client: ollama.AsyncClient,
+        pairs: List[Tuple[Dict[str, Any], Dict[str, Any]]],
+        label: Optional[int] = None,
+    ) -> List[Tuple[Dict[str, Any], Dict[str, Any]]]:
+        """
+        Normalize several same-label pairs with one LLM call.
+        Pairs with nothing to normalize skip the LLM; a malformed batch
+        answer falls back to one call per pair.
+        """
+        results: List[Optional[Tuple[Dict[str, Any], Dict[str, Any]]]] = [None] * len(pairs)
+        llm_idx = []
+        for i, (left_record, right_record) in enumerate(pairs):
+            if self._is_trivial(left_record) and self._is_trivial(right_record):
+                # Deterministic fast path: missing cells become ""/"unknown", as the prompt asks of the LLM
+                results[i] = (
+                    self.normalize_llm_output({k: v for k, v in left_record.items() if pd.notna(v)}),
+                    self.normalize_llm_output({k: v for k, v in right_record.items() if pd.notna(v)}),
+                )
+                self.fast_path_hits += 1
+            else:
+                llm_idx.append(i)
+        if llm_idx:
+            cleaned = await self._extract_batch_llm(client, [pairs[i] for i in llm_idx], label)
+            for i, pair_out in zip(llm_idx, cleaned):
+                results[i] = pair_out
+        return results
+
+    async def _extract_batch_llm(
+        self,
+        client: ollama.AsyncClient,
+        pairs: List[Tuple[Dict[str, Any], Dict[str, Any]]],
+        label: Optional[int] = None,
+    ) -> List[Tuple[Dict[str, Any], Dict[str, Any]]]:
+        if len(pairs) == 1:
+            left_record, right_record = pairs[0]
+            return [await self.extract_pair_standardized_attributes(client, left_record, right_record, label)]
 
-            new_row: Dict[str, Any] = {
-                "id": row_dict.get("id"),
-                "label": raw_label,
-            }
-            for k, v in left_cleaned.items():
-                new_row[f"left_{k}"] = v
-            for k, v in right_cleaned.items():
-                new_row[f"right_{k}"] = v
-            all_rows.append(new_row)
+        instructions, records = self._build_prompt(pairs, label)
+        try:
+            parsed = await self._chat_json(client, instructions, records, n_pairs=len(pairs))
+            if isinstance(parsed, dict):
+                parsed = parsed.get("results")
+            if not isinstance(parsed, list) or len(parsed) != len(pairs):
+                raise ValueError(f"expected a results array of {len(pairs)} objects")
+            results = []
+            for item in parsed:
+                left_out = self.normalize_llm_output(item.get("left", {}))
+                right_out = self.normalize_llm_output(item.get("right", {}))
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug("left : %s ---- right: %s", left_out, right_out)
+                results.append((left_out, right_out))
+            return results
+        except Exception as e:
+            log.warning("❌ Batch extraction error: %s; retrying %d pairs one by one", e, len(pairs))
+            return [
+                await self.extract_pair_standardized_attributes(client, left_record, right_record, label)
+                for left_record, right_record in pairs
+            ]
 
-        enriched_df = pd.DataFrame(all_rows)
-        print(f"💾 Saving enriched data to {output_csv}")
-        enriched_df.to_csv(output_csv, index=False)
+    # -------------------- Dataset utilities --------------------
+    def split_columns(self, columns: List[str], side: str) -> List[Tuple[str, str]]:
+        """Map each `{side}_*` column to its bare key; computed once per CSV."""
+        prefix = f"{side}_"
+        return [(col, col[len(prefix):]) for col in columns if col.startswith(prefix)]
 
+    def _output_row(
+        self,
+        row_dict: Dict[str, Any],
+        label_val: Optional[int],
+        left_cleaned: Dict[str, Any],
+        right_cleaned: Dict[str, Any],
+    ) -> Dict[str, Any]:
+        new_row: Dict[str, Any] = {
+            "id": row_dict.get("id"),
+            # pandas wrote missing labels as empty cells
+            "label": row_dict.get("label") if label_val is not None else None,
+        }
+        # NaN prices are written as empty cells, as DataFrame.to_csv did
+        for k, v in left_cleaned.items():
+            new_row[f"left_{k}"] = None if isinstance(v, float) and v != v else v
+        for k, v in right_cleaned.items():
+            new_row[f"right_{k}"] = None if isinstance(v, float) and v != v else v
+        return new_row
+
+    def _written_ids(self, output_csv: str, fieldnames: List[str]) -> Optional[Set[str]]:
+        """
+        Ids already present in an earlier (possibly interrupted) output with the
+        same header, or None when there is nothing to resume from.
+        """
+        if not os.path.exists(output_csv):
+            return None
+        with open(output_csv, "r+", newline="", encoding="utf-8") as f:
+            data = f.read()
+            # Drop a partial last row left behind by an interrupted write
+            complete = data[: data.rfind("\n") + 1]
+            if complete != data:
+                f.seek(0)
+                f.write(complete)
+                f.truncate()
+        rows = list(csv.reader(io.StringIO(complete)))
+        if not rows or rows[0] != fieldnames:
+            return None
+        return {row[0] for row in rows[1:] if row}
+
+    def process_dataset(self, input_csv: str, output_csv: str, resume: bool = True) -> None:
+        asyncio.run(self._process_dataset(input_csv, output_csv, resume))
+
+    async def _process_dataset(self, input_csv: str, output_csv: str, resume: bool = True) -> None:
+        print(f"📄 Reading data from {input_csv}...")
+        reader = pd.read_csv(input_csv, chunksize=self.chunk_size)
+        next_chunk = lambda: next(reader, None)
+        chunk = await asyncio.to_thread(next_chunk)
+        if chunk is None:
+            return
+        left_cols = self.split_columns(list(chunk.columns), "left")
+        right_cols = self.split_columns(list(chunk.columns), "right")
+
+        fieldnames = ["id", "label"] + [f"left_{k}" for k in EXPECTED_KEYS] + [f"right_{k}" for k in EXPECTED_KEYS]
+        done = self._written_ids(output_csv, fieldnames) if resume else None
+        if done is not None:
+            print(f"↩️  Resuming {output_csv}: {len(done)} rows already written")
+
+        self.fast_path_hits = 0
+        duplicates = 0
+        sems = [asyncio.Semaphore(self.max_concurrency) for _ in self.hosts]
+        progress = tqdm(unit="pair")
+
+        async def _run_chunk(df: pd.DataFrame) -> None:
+            nonlocal duplicates
+            # Identical (label, left, right) pairs in a chunk go to the LLM once; every
+            # row then reads its result from the pair's slot in `pairs`. Dedup state is
+            # per chunk so memory stays bounded; repeats across chunks are left to the
+            # reply cache.
+            rows: List[Tuple[Dict[str, Any], Optional[int], Tuple[Optional[int], bytes, bytes]]] = []
+            pairs: List[Tuple[Optional[int], Dict[str, Any], Dict[str, Any]]] = []
+            unique: Dict[Tuple[Optional[int], bytes, bytes], int] = {}
+            for row_dict in df.to_dict(orient="records"):
+                if done and str(row_dict.get("id")) in done:
+                    continue
+                raw_label = row_dict.get("label", None)
+                try:
+                    label_val: Optional[int] = int(raw_label) if pd.notna(raw_label) else None
+                except Exception:
+                    label_val = None
+                left_input = {key: row_dict[col] for col, key in left_cols}
+                right_input = {key: row_dict[col] for col, key in right_cols}
+                pair_key = (
+                    label_val,
+                    orjson.dumps(left_input, option=orjson.OPT_SORT_KEYS),
+                    orjson.dumps(right_input, option=orjson.OPT_SORT_KEYS),
+                )
+                if pair_key not in unique:
+                    unique[pair_key] = len(pairs)
+                    pairs.append((label_val, left_input, right_input))
+                rows.append((row_dict, label_val, pair_key))
+            duplicates += len(rows) - len(pairs)
+
+            async def _bounded(batch: List[int], shard: int) -> List[Tuple[Dict[str, Any], Dict[str, Any]]]:
+                batch_pairs = [(pairs[i][1], pairs[i][2]) for i in batch]
+                async with sems[shard]:
+                    cleaned = await self.extract_batch_standardized_attributes(
+                        clients[shard], batch_pairs, label=pairs[batch[0]][0]
+                    )
+                progress.update(len(batch))
+                return cleaned
+
+            # Runs of consecutive same-label pairs, cut into batches of at most batch_size;
+            # slot[i] is (batch number, position in batch) of unique pair i
+            batches: List[List[int]] = []
+            slot: List[Tuple[int, int]] = []
+            for _, run in groupby(range(len(pairs)), key=lambda i: pairs[i][0]):
+                while True:
+                    batch = list(islice(run, self.batch_size))
+                    if not batch:
+                        break
+                    slot.extend((len(batches), pos) for pos in range(len(batch)))
+                    batches.append(batch)
+
+            # All batches run concurrently; rows are written in CSV order as their batch finishes
+            tasks = [
+                asyncio.create_task(_bounded(batch, i % len(clients)))
+                for i, batch in enumerate(batches)
+            ]
+            for row_dict, label_val, pair_key in rows:
+                batch_no, pos = slot[unique[pair_key]]
+                if not tasks[batch_no].done():
+                    # Flush before waiting so an interrupted run stays resumable
+                    f.flush()
+                left_cleaned, right_cleaned = (await tasks[batch_no])[pos]
+                writer.writerow(self._output_row(row_dict, label_val, left_cleaned, right_cleaned))
+
+        print(f"💾 Streaming enriched data to {output_csv}")
+        # One client per replica, and so one keep-alive connection pool each, serves
+        # the whole pass. Clients are bound to this event loop, so they close with it.
+        async with AsyncExitStack() as stack:
+            clients = [
+                await stack.enter_async_context(ollama.AsyncClient(host=h, timeout=self.timeout))
+                for h in self.hosts
+            ]
+            with open(output_csv, "a" if done is not None else "w", newline="", encoding="utf-8") as f:
+                writer = csv.DictWriter(f, fieldnames=fieldnames, restval="", extrasaction="ignore", lineterminator="\n")
+                if done is None:
+                    writer.writeheader()
+                while chunk is not None:
+                    # Parse the next chunk in a worker thread while this one is dispatched
+                    upcoming = asyncio.create_task(asyncio.to_thread(next_chunk))
+                    await _run_chunk(chunk)
+                    chunk = await upcoming
+        progress.close()
+        if duplicates:
+            print(f"🔁 {duplicates} duplicate pairs reused an earlier result")
+        if self.fast_path_hits:
+            print(f"⚡ {self.fast_path_hits} empty pairs skipped the LLM")
 
 def main() -> None:
-    extractor = OllamaFeatureExtractor()
+    logging.basicConfig(
+        level=logging.DEBUG if "--verbose" in sys.argv[1:] else logging.INFO,
+        format="%(message)s",
+    )
+    # httpx logs every request at INFO, which would bring per-row output back
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    extractor = OllamaFeatureExtractor(use_cache="--no-cache" not in sys.argv[1:])
 
     for split in ["train", "valid", "test"]:
         input_file = f"{split}.csv"
         output_file = f"{split}_enriched.csv"
         if os.path.exists(input_file):
             print(f"\n🟡 Processing {split}...")
-            extractor.process_dataset(input_file, output_file)
+            extractor.process_dataset(input_file, output_file, resume="--no-resume" not in sys.argv[1:])
         else:
             print(f"⚠️  {input_file} not found, skipping...")
 
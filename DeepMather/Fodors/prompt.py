@@ -1,221 +1,531 @@
+import asyncio
+import csv
+import hashlib
+import io
+import logging
+import random
+import sqlite3
+import sys
+from collections import deque
+import httpx
 import pandas as pd
 import ollama
 from tqdm import tqdm
 import re
 import json
+import orjson
 import os
-from typing import Dict, Any, Tuple
+from typing import Deque, Dict, Any, List, Literal, Optional, Set, Tuple
 
-# Expected output keys for each side
+# Per-batch diagnostics; the parsed replies are DEBUG (run with --verbose to see them)
+log = logging.getLogger(__name__)
+
+# Expected output keys for each side. The input columns say "addr", but the prompt
+# asks for "address" and every earlier *_enriched.csv has left_/right_address
 EXPECTED_KEYS = [
     "name",
-    "addr",
+    "address",
     "city",
     "phone",
     "category",
     "class",
 ]
 
+# A normalized pair is ~120 tokens; the per-pair cap is doubled once if a reply is cut off
+NUM_PREDICT = 256
+# Context window per request: the few-shot system prompt plus a batch of records and
+# its reply fit well inside it, and a fixed value keeps every request on the same
+# loaded context (a smaller KV cache per slot than the model default also leaves room
+# for more OLLAMA_NUM_PARALLEL slots)
+NUM_CTX = 4096
+# Stop at a closing code fence rather than letting the model ramble after the JSON
+STOP_SEQUENCES = ["\n```"]
+
+# Failures worth another attempt: malformed JSON, and the server being unreachable
+# or timing out (ollama raises ConnectionError; timeouts surface from httpx)
+TRANSIENT_ERRORS = (json.JSONDecodeError, ConnectionError, httpx.TransportError)
+RETRY_ATTEMPTS = 3
+# Backoff before retry n is min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2**n) plus up to 1s of jitter
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 8.0
+
+# Worked examples for the "few" prompt style, sent until the model has warmed up on
+# this dataset; after FEW_SHOT_WARMUP successful replies they are dropped from the
+# system prompt. The "zero" style never sends them.
+FEW_SHOT_WARMUP = 20
+FEW_SHOT_EXAMPLES = """Examples:
+IN: [1]
+Left: {"name":"` le chardonnay ( los angeles ) '","addr":"' 6703 melrose ave. '","city":"` los angeles '","phone":"213/857 -0034","category":"californian","class":6}
+Right: {"name":"french bistro","addr":"' 8284 melrose ave. '","city":"los angeles","phone":"213-655-8880","category":"` french bistro '","class":12}
+OUT: {"results": [{"left": {"name": "Le Chardonnay", "address": "6703 Melrose Avenue", "city": "Los Angeles", "phone": "213-857-0034", "category": "californian", "class": 6}, "right": {"name": "French Bistro", "address": "8284 Melrose Avenue", "city": "Los Angeles", "phone": "213-655-8880", "category": "french bistro", "class": 12}}]}
+IN: [1]
+Left: {"name":"` yujean kang \\\\ 's gourmet chinese cuisine '","addr":"'67 n. raymond ave. '","city":"` los angeles '","phone":"818/585 -0855","category":"asian","class":22}
+Right: {"name":"` yujean kang \\\\ 's '","addr":"'67 n. raymond ave. '","city":"pasadena","phone":"818-585-0855","category":"chinese","class":22}
+OUT: {"results": [{"left": {"name": "Yujean Kang's Gourmet Chinese Cuisine", "address": "67 North Raymond Avenue", "city": "Pasadena", "phone": "818-585-0855", "category": "asian", "class": 22}, "right": {"name": "Yujean Kang's", "address": "67 North Raymond Avenue", "city": "Pasadena", "phone": "818-585-0855", "category": "chinese", "class": 22}}]}
+IN: [1]
+Left: {"name":"` bone \\\\ 's '","addr":"' 3130 piedmont road '","city":"atlanta","phone":"404/237 -2663","category":"american","class":76}
+Right: {"name":"` joe \\\\ 's '","addr":"' 1023 abbot kinney blvd. '","city":"venice","phone":"310-399-5811","category":"` american ( new ) '","class":560}
+OUT: {"results": [{"left": {"name": "Bone's", "address": "3130 Piedmont Road", "city": "Atlanta", "phone": "404-237-2663", "category": "american", "class": 76}, "right": {"name": "Joe's", "address": "1023 Abbot Kinney Boulevard", "city": "Venice", "phone": "310-399-5811", "category": "american (new)", "class": 560}}]}
+"""
+
+# Markdown code fences some models wrap their JSON in
+FENCE_OPEN_RE = re.compile(r"^```[a-zA-Z]*\n?")
+FENCE_CLOSE_RE = re.compile(r"```$")
+
+class PairCache:
+    """
+    Normalized (left, right) outputs keyed by a hash of the model, prompt style,
+    prompt version and input pair.
+    Kept in memory and, when a path is given, persisted to SQLite so repeated
+    pairs across splits and reruns skip the LLM entirely.
+    """
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self._mem: Dict[str, Tuple[Dict[str, Any], Dict[str, Any]]] = {}
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, isolation_level=None)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS pairs (hash TEXT PRIMARY KEY, left_json TEXT, right_json TEXT)"
+            )
+
+    @staticmethod
+    def key(model: str, prompt_style: str, prompt_version: str, left: Dict[str, Any], right: Dict[str, Any]) -> str:
+        payload = orjson.dumps(
+            {"m": model, "p": prompt_style, "v": prompt_version, "l": left, "r": right}, option=orjson.OPT_SORT_KEYS
+        )
+        return hashlib.blake2b(payload).hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[Dict[str, Any], Dict[str, Any]]]:
+        if key in self._mem:
+            return self._mem[key]
+        if self._db is not None:
+            row = self._db.execute("SELECT left_json, right_json FROM pairs WHERE hash = ?", (key,)).fetchone()
+            if row is not None:
+                value = (orjson.loads(row[0]), orjson.loads(row[1]))
+                self._mem[key] = value
+                return value
+        return None
+
+    def set(self, key: str, left: Dict[str, Any], right: Dict[str, Any]) -> None:
+        self._mem[key] = (left, right)
+        if self._db is not None:
+            self._db.execute(
+                "INSERT OR REPLACE INTO pairs (hash, left_json, right_json) VALUES (?, ?, ?)",
+                (key, orjson.dumps(left).decode(), orjson.dumps(right).decode()),
+            )
+
+
 class OllamaFeatureExtractor:
-    def __init__(self, model_name: str = "gemma3:12b") -> None:
+    def __init__(
+        self,
+        model_name: str = "gemma3:12b-it-q4_K_M",
+        max_concurrency: Optional[int] = None,
+        use_cache: bool = True,
+        cache_path: Optional[str] = ".prompt_cache.sqlite",
+        batch_size: int = 4,
+        host: Optional[str] = None,
+        keep_alive: str = "1h",
+        num_gpu: Optional[int] = None,
+        prompt_style: Literal["zero", "few"] = "few",
+    ) -> None:
+        if prompt_style not in ("zero", "few"):
+            raise ValueError(f"prompt_style must be 'zero' or 'few', got {prompt_style!r}")
+        # Zero-shot (rules only) or few-shot (rules plus warm-up examples)
+        self.prompt_style = prompt_style
+        # Pinned to the Q4_K_M quantization rather than whatever the bare tag points at
         self.llm_model = model_name
-
+        # Layers offloaded to the GPU; None lets Ollama fit as many as VRAM allows,
+        # 99 forces the whole model onto the GPU
+        self.num_gpu = num_gpu
+        # Server address; None lets ollama read OLLAMA_HOST (default http://localhost:11434)
+        self.host = host
+        # Keep the model loaded between requests so idle gaps never pay a reload
+        self.keep_alive = keep_alive
+        # Successful pair outputs, keyed per prompt version (see _prompt_version)
+        self.cache = PairCache(cache_path) if use_cache else None
+        # Consecutive pairs sent per LLM call, so the instructions are prefilled once per batch
+        self.batch_size = max(1, batch_size)
+        # In-flight requests per dataset. Match the server's parallel slots: start
+        # `ollama serve` with OLLAMA_NUM_PARALLEL=N; the same variable is read here.
+        if max_concurrency is None:
+            max_concurrency = int(os.environ.get("OLLAMA_NUM_PARALLEL", 8))
+        self.max_concurrency = max_concurrency
+        # Static instructions, built once so every request shares a byte-identical
+        # prefix and Ollama can reuse its prompt KV cache across rows
+        self._system_prompt = self._build_system_prompt(include_examples=True)
+        self._system_prompt_lean = self._build_system_prompt(include_examples=False)
+        # Part of every cache key, so editing the prompts or options never reuses old answers
+        self.prompt_version = self._prompt_version()
+        # Few-shot warm-up: examples go out until FEW_SHOT_WARMUP replies parse, and
+        # come back after two consecutive failures without them
+        self._use_fewshot = prompt_style == "few"
+        self._success_count = 0
+        self._lean_failures = 0
+        # Pairs answered without the LLM in the current pass
+        self.fast_path_hits = 0
+
+
+    # Standard key for every name the model may use; an echoed input column "addr" is "address"
+    _KEY_VARIANTS: Dict[str, str] = {"addr": "address", **{key: key for key in EXPECTED_KEYS}}
 
     def normalize_llm_output(self, response: Dict[str, Any]) -> Dict[str, Any]:
-        """Ensure all expected keys exist, map variants, and coerce types."""
-        key_map = {
-            
-            "name":"name",
-            "addr":"addr",
-            "city":"city",
-            "phone":"phone",
-            "category":"category",
-            "class":"class"
-        }
-        normalized: Dict[str, Any] = {}
+        """Validate one side: map key variants, drop unknown keys, fill missing or null fields with ""."""
+        if not isinstance(response, dict):
+            raise TypeError(f"expected a JSON object, got {type(response).__name__}")
+        normalized = dict.fromkeys(EXPECTED_KEYS, "")
         for key, value in response.items():
-            std_key = key_map.get(key, key)
-            normalized[std_key] = value
+            std_key = self._KEY_VARIANTS.get(key)
+            if std_key is not None and value is not None:
+                normalized[std_key] = value
         return normalized
 
-    # -------------------- LLM prompt (pair) --------------------
-    def _build_pair_prompt(self, left: Dict[str, Any], right: Dict[str, Any]) -> str:
-        
-        return f"""
-You are a data normalization expert. Your job is to clean and standardize structured data records for entity matching:
-
-You are a data normalization expert. Clean and standardize TWO structured restaurant records at once.
-Return a SINGLE valid JSON object with exactly two top-level keys: "left" and "right".
-Each side must follow the schema below .
----
-## Normalization Rule for the title:
-## General Cleaning
-- Remove surrounding quotes/backticks from values.
-- Strip extra whitespace, collapse multiple spaces into one.
-- Convert phone numbers to standard format: NNN-NNN-NNNN (U.S. style), remove slashes/spaces.
-- Expand abbreviations in address (St. → Street, Ave. → Avenue, Rd. → Road, Blvd. → Boulevard, NE/NW/SE/SW stays).
-- Normalize city names to their common full form ("la" → "Los Angeles", "nyc" → "New York City").
-- Remove state names or zip codes from address if already represented in the city field.
-
-## Restaurant Name
-- Remove location suffixes in parentheses unless part of the official name ("Le Chardonnay (Los Angeles)" → "Le Chardonnay").
-- Remove extra quotes/backslashes.
-- Keep brand or chain identifiers if part of the official name.
-- Preserve distinctive tokens (e.g., "Cafe", "Grill", "Bistro").
-
-## Category & Class
-- Category: normalize to a consistent lowercase-with-spaces form (e.g., "french bistro", "american (new)").
-- Class: keep as-is if numeric; else normalize to title case for text classes.
-
-## Missing Values
-- If a field is missing, use an empty string "" (never null).
-
-
-
-Output JSON schema (MUST follow):
-{{
-  "left": {{
-    "name": string ,
-    "address": string, 
-    "city": string ,
-    "phone": string ,
-    "category": string,
-    "class":string
-  }},
-  "right": {{
-    
-    "name": string ,
-    "address": string, 
-    "city": string ,
-    "phone": string ,
-    "category": string,
-    "class":string
-  }}
-}}
-
-
-
-Now process this record:
-
-Left record input:
-{json.dumps(left, ensure_ascii=False , indent=2)}
-
-Right record input:
-{json.dumps(right, ensure_ascii=False ,indent=2 )}
-
-📘 Output JSON schema (always follow):
-{{
-  "left":  {{ 
-    "name": string ,
-    "address": string, 
-    "city": string ,
-    "phone": string ,
-    "category": string,
-    "class":string 
-    }},
-  "right": {{ 
-    
-    "name": string ,
-    "address": string, 
-    "city": string ,
-    "phone": string ,
-    "category": string,
-    "class":string
-  }}
-}}
-
-⚠️ OUTPUT RULES — STRICTLY FOLLOW:
-- Output must be valid JSON.
-- Do NOT include backticks, explanations, markdown, or anything outside the JSON object.
-- Do NOT say "Here is the output" or "Note: I've normalized".
-- Just return the JSON object. No comments, headers, or notes.
-
-"""
-
-    def extract_pair_standardized_attributes(
-        self, left_record: Dict[str, Any], right_record: Dict[str, Any]
+    def _is_trivial(self, record: Dict[str, Any]) -> bool:
+        """True when every field of a record is missing or blank."""
+        for value in record.values():
+            if pd.notna(value) and str(value).strip():
+                return False
+        return True
+
+    # -------------------- LLM prompt (batch) --------------------
+    def _build_system_prompt(self, include_examples: bool) -> str:
+        rules = """You are a data normalization expert. Clean and standardize pairs of restaurant records for entity matching.
+Rules:
+1. Remove surrounding quotes, backticks and backslashes from values; trim and collapse whitespace.
+2. Phone: NNN-NNN-NNNN (U.S. style), no slashes or spaces.
+3. Address: expand abbreviations (St. -> Street, Ave. -> Avenue, Rd. -> Road, Blvd. -> Boulevard; keep NE/NW/SE/SW); drop state or zip already given by city.
+4. City: common full form ("la" -> "Los Angeles", "nyc" -> "New York City").
+5. Name: drop location suffixes in parentheses unless part of the official name ("Le Chardonnay (Los Angeles)" -> "Le Chardonnay"); keep chain identifiers and distinctive tokens (Cafe, Grill, Bistro).
+6. Category: lowercase with spaces ("french bistro", "american (new)").
+7. Class: the integer class id, unchanged.
+8. Missing fields are "" (never null).
+The input holds numbered pairs [1]..[n]. Return ONLY one JSON object whose "results" array has one object per pair, in order, with no markdown or notes, ending with its closing } and nothing after:
+{"results": [{"left": {"name": string, "address": string, "city": string, "phone": string, "category": string, "class": integer}, "right": {same keys}}]}"""
+        if include_examples:
+            return rules + "\n" + FEW_SHOT_EXAMPLES
+        return rules
+
+    def _build_batch_prompt(self, pairs: List[Tuple[Dict[str, Any], Dict[str, Any]]]) -> str:
+        blocks = [
+            f"[{i}]\nLeft: {orjson.dumps(left).decode()}\nRight: {orjson.dumps(right).decode()}"
+            for i, (left, right) in enumerate(pairs, 1)
+        ]
+        return "Records:\n" + "\n".join(blocks)
+
+    def _prompt_version(self) -> str:
+        """
+        Hash of everything besides the records that shapes a reply: the system
+        prompts this style can send, the record layout (rendered around an empty
+        probe pair) and the fixed request options.
+        """
+        prompts = [self._system_prompt_lean]
+        if self.prompt_style == "few":
+            prompts.append(self._system_prompt)
+        probe = dict.fromkeys(EXPECTED_KEYS, "")
+        payload = orjson.dumps(
+            [
+                prompts,
+                self._build_batch_prompt([(probe, probe)]),
+                {"temperature": 0.0, "num_ctx": NUM_CTX, "stop": STOP_SEQUENCES},
+            ]
+        )
+        return hashlib.blake2b(payload).hexdigest()
+
+    def _record_parse(self, ok: bool, with_examples: bool) -> None:
+        if ok:
+            self._success_count += 1
+            self._lean_failures = 0
+            if self._use_fewshot and self._success_count >= FEW_SHOT_WARMUP:
+                self._use_fewshot = False
+        elif not with_examples and self.prompt_style == "few":
+            self._lean_failures += 1
+            if self._lean_failures >= 2:
+                # The lean prompt is not holding up; warm up with examples again
+                self._use_fewshot = True
+                self._success_count = 0
+                self._lean_failures = 0
+
+    async def _chat(
+        self, client: ollama.AsyncClient, prompt: str, num_predict: int, include_examples: bool
+    ) -> Any:
+        options = {"temperature": 0.0, "num_predict": num_predict, "num_ctx": NUM_CTX, "stop": STOP_SEQUENCES}
+        if self.num_gpu is not None:
+            options["num_gpu"] = self.num_gpu
+        return await client.chat(
+            model=self.llm_model,
+            keep_alive=self.keep_alive,
+            options=options,
+            messages=[
+                {
+                    "role": "system",
+                    "content": self._system_prompt if include_examples else self._system_prompt_lean
+                },
+                {
+                    "role": "user",
+                    "content": prompt
+                }
+            ],
+        )
+
+    async def extract_pair_standardized_attributes(
+        self, client: ollama.AsyncClient, left_record: Dict[str, Any], right_record: Dict[str, Any]
+    ) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """Normalize one pair; raises if it still fails after RETRY_ATTEMPTS tries."""
+        pair_out = (await self.extract_batch_standardized_attributes(client, [(left_record, right_record)]))[0]
+        if pair_out is None:
+            raise RuntimeError(f"extraction failed after {RETRY_ATTEMPTS} attempts")
+        return pair_out
+
+    async def extract_batch_standardized_attributes(
+        self, client: ollama.AsyncClient, pairs: List[Tuple[Dict[str, Any], Dict[str, Any]]]
+    ) -> List[Optional[Tuple[Dict[str, Any], Dict[str, Any]]]]:
+        """
+        Normalize several pairs with one LLM call. Empty and cached pairs skip
+        the LLM; pairs that still fail after retries come back as None and are
+        not cached.
+        """
+        results: List[Optional[Tuple[Dict[str, Any], Dict[str, Any]]]] = [None] * len(pairs)
+        keys: List[Optional[str]] = [None] * len(pairs)
+        misses = []
+        for i, (left_record, right_record) in enumerate(pairs):
+            if self._is_trivial(left_record) and self._is_trivial(right_record):
+                # Deterministic fast path: every field is "", as the prompt asks of the LLM
+                results[i] = (self.normalize_llm_output({}), self.normalize_llm_output({}))
+                self.fast_path_hits += 1
+                continue
+            if self.cache is not None:
+                keys[i] = PairCache.key(self.llm_model, self.prompt_style, self.prompt_version, left_record, right_record)
+                results[i] = self.cache.get(keys[i])
+            if results[i] is None:
+                misses.append(i)
+
+        if misses:
+            cleaned = await self._extract_batch_llm(client, [pairs[i] for i in misses])
+            for i, pair_out in zip(misses, cleaned):
+                if pair_out is not None and keys[i] is not None:
+                    self.cache.set(keys[i], *pair_out)
+                results[i] = pair_out
+        return results
+
+    async def _extract_batch_llm(
+        self, client: ollama.AsyncClient, pairs: List[Tuple[Dict[str, Any], Dict[str, Any]]]
+    ) -> List[Optional[Tuple[Dict[str, Any], Dict[str, Any]]]]:
+        """One LLM call for all pairs; a failed batch falls back to one call per pair, with retries."""
+        if len(pairs) > 1:
+            try:
+                return await self._call_llm(client, pairs)
+            except Exception as e:
+                log.warning("❌ Batch extraction error: %s; retrying %d pairs one by one", e, len(pairs))
+
+        results: List[Optional[Tuple[Dict[str, Any], Dict[str, Any]]]] = []
+        for pair in pairs:
+            try:
+                results.append(await self._call_llm_with_retry(client, pair))
+            except Exception as e:
+                log.warning("❌ Extraction error: %s", e)
+                results.append(None)
+        return results
+
+    async def _call_llm_with_retry(
+        self, client: ollama.AsyncClient, pair: Tuple[Dict[str, Any], Dict[str, Any]]
     ) -> Tuple[Dict[str, Any], Dict[str, Any]]:
-        prompt = self._build_pair_prompt(left_record, right_record)
+        for attempt in range(RETRY_ATTEMPTS):
+            try:
+                return (await self._call_llm(client, [pair]))[0]
+            except TRANSIENT_ERRORS as e:
+                if attempt == RETRY_ATTEMPTS - 1:
+                    raise
+                delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt) + random.uniform(0, 1)
+                log.warning("⚠️ %s: %s; retrying in %.1fs", type(e).__name__, e, delay)
+                await asyncio.sleep(delay)
+        raise AssertionError("unreachable")
+
+    async def _call_llm(
+        self, client: ollama.AsyncClient, pairs: List[Tuple[Dict[str, Any], Dict[str, Any]]]
+    ) -> List[Tuple[Dict[str, Any], Dict[str, Any]]]:
+        """A single LLM request for the given pairs; raises on any failure."""
+        prompt = self._build_batch_prompt(pairs)
+        include_examples = self._use_fewshot
+        response = await self._chat(client, prompt, NUM_PREDICT * len(pairs), include_examples)
+        if response.get("done_reason") == "length":
+            # Hit the token cap mid-JSON; retry once with twice the budget
+            response = await self._chat(client, prompt, 2 * NUM_PREDICT * len(pairs), include_examples)
+        content = response["message"]["content"].strip()
+        if content.startswith("```"):
+            content = FENCE_OPEN_RE.sub("", content)
+            content = FENCE_CLOSE_RE.sub("", content).strip()
         try:
-            response = ollama.chat(
-                model=self.llm_model,
-                options={"temperature": 0.0, "num_predict": 2000},
-                messages=[
-                    {
-                        "role": "system",
-                        "content": (
-                            "You are entity matcher for the ditto. Do not explain. "
-                            "Do not describe anything. Do not say 'Output:' or '<think>'. "
-                            "Do not provide reasoning, steps, formatting explanation, or notes. "
-                            "Return EXACTLY one line with TWO transformed records separated by ONE real tab character. PRESERVE ORIGINAL CASE. Do NOT change to title case. Do not capitalize words unless already capitalized. "
-                            "No headings. No thoughts. No multiple lines. No Markdown. No JSON. Only raw string output. "
-                            "If you violate this, your output will be rejected."
-                        )
-                    },
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
-                ],
-            )
-            content = response["message"]["content"].strip()
-            if content.startswith("```"):
-                content = re.sub(r"^```[a-zA-Z]*\n?", "", content)
-                content = re.sub(r"```$", "", content).strip()
-            parsed = json.loads(content)
-            print("passed",parsed)
-            left_out = self.normalize_llm_output(parsed.get("left", {}))
-            right_out = self.normalize_llm_output(parsed.get("right", {}))
-            return left_out, right_out
-        except json.JSONDecodeError as jde:
-            print(f"❌ JSON decode error: {jde}")
-            print("⚠️ Content that failed parsing:", content if 'content' in locals() else None)
-            # Fallback to empty normalized objects
-            return self.normalize_llm_output({}), self.normalize_llm_output({})
+            parsed = orjson.loads(content)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("parsed: %s", parsed)
+            # A lone pair may still come back as a bare {"left", "right"} object
+            items = parsed.get("results", [parsed]) if isinstance(parsed, dict) else parsed
+            if not isinstance(items, list) or len(items) != len(pairs):
+                raise ValueError(f"expected a results array of {len(pairs)} objects")
+            results = [
+                (self.normalize_llm_output(item.get("left", {})), self.normalize_llm_output(item.get("right", {})))
+                for item in items
+            ]
         except Exception as e:
-            print(f"❌ Unexpected error: {e}")
-            return self.normalize_llm_output({}), self.normalize_llm_output({})
+            # orjson.JSONDecodeError subclasses json.JSONDecodeError
+            if isinstance(e, json.JSONDecodeError):
+                log.warning("⚠️ Content that failed parsing: %s", content)
+            self._record_parse(False, include_examples)
+            raise
+        self._record_parse(True, include_examples)
+        return results
 
     # -------------------- Dataset utilities --------------------
-    def split_record(self, row: Dict[str, Any], side: str) -> Dict[str, Any]:
-        return {col[len(f"{side}_"):]: row[col] for col in row if col.startswith(f"{side}_")}
-
-    def process_dataset(self, input_csv: str, output_csv: str) -> None:
+    def split_columns(self, columns: List[str], side: str) -> List[Tuple[str, str]]:
+        """Map each `{side}_*` column to its bare key; computed once per CSV."""
+        prefix = f"{side}_"
+        return [(col, col[len(prefix):]) for col in columns if col.startswith(prefix)]
+
+    def _written_ids(self, output_csv: str, fieldnames: List[str]) -> Optional[Set[str]]:
+        """
+        Ids already present in an earlier (possibly interrupted) output with the
+        same header, or None when there is nothing to resume from.
+        """
+        if not os.path.exists(output_csv):
+            return None
+        with open(output_csv, "r+", newline="", encoding="utf-8") as f:
+            data = f.read()
+            # Drop a partial last row left behind by an interrupted write
+            complete = data[: data.rfind("\n") + 1]
+            if complete != data:
+                f.seek(0)
+                f.write(complete)
+                f.truncate()
+        rows = list(csv.reader(io.StringIO(complete)))
+        if not rows or rows[0] != fieldnames:
+            return None
+        return {row[0] for row in rows[1:] if row}
+
+    def _restore_input_order(self, output_csv: str, ids: List[str]) -> None:
+        """
+        Rewrite a resumed output so its rows follow the input order again. Rows
+        that failed in an earlier run were appended at the end by the resume;
+        after this the file matches what a clean run would have written.
+        """
+        with open(output_csv, newline="", encoding="utf-8") as f:
+            header, *rows = csv.reader(f)
+        position = {row_id: i for i, row_id in enumerate(ids)}
+        rows.sort(key=lambda row: position.get(row[0], len(position)))
+        with open(output_csv, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f, lineterminator="\n")
+            writer.writerow(header)
+            writer.writerows(rows)
+
+    def process_dataset(self, input_csv: str, output_csv: str, resume: bool = True) -> None:
+        asyncio.run(self._process_dataset(input_csv, output_csv, resume))
+
+    async def _process_dataset(self, input_csv: str, output_csv: str, resume: bool = True) -> None:
         print(f"📄 Reading data from {input_csv}...")
         df = pd.read_csv(input_csv)
-        all_rows = []
-
-        for _, row in tqdm(df.iterrows(), total=len(df)):
-            row_dict = row.to_dict()
-            left_input = self.split_record(row_dict, "left")
-            right_input = self.split_record(row_dict, "right")
-
-            left_cleaned, right_cleaned = self.extract_pair_standardized_attributes(left_input, right_input)
-
-            new_row: Dict[str, Any] = {
-                "id": row_dict.get("id"),
-                "label": row_dict.get("label"),
-            }
-            for k, v in left_cleaned.items():
-                new_row[f"left_{k}"] = v
-            for k, v in right_cleaned.items():
-                new_row[f"right_{k}"] = v
-            all_rows.append(new_row)
-
-        enriched_df = pd.DataFrame(all_rows)
-        print(f"💾 Saving enriched data to {output_csv}")
-        enriched_df.to_csv(output_csv, index=False)
+        left_cols = self.split_columns(list(df.columns), "left")
+        right_cols = self.split_columns(list(df.columns), "right")
+
+        fieldnames = ["id", "label"] + [f"left_{k}" for k in EXPECTED_KEYS] + [f"right_{k}" for k in EXPECTED_KEYS]
+        done = self._written_ids(output_csv, fieldnames) if resume else None
+        if done is not None:
+            print(f"↩️  Resuming {output_csv}: {len(done)} rows already written")
+        # One conversion up front instead of a Series per row from iterrows()
+        rows: List[Dict[str, Any]] = df.to_dict("records")
+        input_ids = [str(row_dict.get("id")) for row_dict in rows]
+        if done:
+            rows = [row_dict for row_dict in rows if str(row_dict.get("id")) not in done]
+
+        sem = asyncio.Semaphore(self.max_concurrency)
+        progress = tqdm(total=len(rows))
+        failed = 0
+        self.fast_path_hits = 0
+
+        async def _bounded(batch: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+            pairs = [
+                ({key: row_dict[col] for col, key in left_cols}, {key: row_dict[col] for col, key in right_cols})
+                for row_dict in batch
+            ]
+
+            nonlocal failed
+            async with sem:
+                cleaned = await self.extract_batch_standardized_attributes(client, pairs)
+            progress.update(len(batch))
+
+            new_rows = []
+            for row_dict, pair_out in zip(batch, cleaned):
+                if pair_out is None:
+                    # Left out of the output, so a resumed run picks the row up again
+                    # (and then puts it back in input order)
+                    failed += 1
+                    continue
+                left_cleaned, right_cleaned = pair_out
+                new_row: Dict[str, Any] = {
+                    "id": row_dict.get("id"),
+                    "label": row_dict.get("label"),
+                }
+                # NaN values are written as empty cells, as DataFrame.to_csv did
+                for k, v in left_cleaned.items():
+                    new_row[f"left_{k}"] = None if isinstance(v, float) and v != v else v
+                for k, v in right_cleaned.items():
+                    new_row[f"right_{k}"] = None if isinstance(v, float) and v != v else v
+                new_rows.append(new_row)
+            return new_rows
+
+        print(f"💾 Streaming enriched data to {output_csv}")
+        # One client, and so one keep-alive connection pool, serves the whole pass.
+        # It is bound to this event loop, so it closes with it.
+        async with ollama.AsyncClient(host=self.host) as client:
+            with open(output_csv, "a" if done is not None else "w", newline="", encoding="utf-8") as f:
+                writer = csv.DictWriter(f, fieldnames=fieldnames, restval="", extrasaction="ignore", lineterminator="\n")
+                if done is None:
+                    writer.writeheader()
+
+                async def _write_oldest() -> None:
+                    task = pending.popleft()
+                    if not task.done():
+                        # Flush before waiting so an interrupted run stays resumable
+                        f.flush()
+                    writer.writerows(await task)
+
+                # Producer/consumer: batches are scheduled at most `window` ahead of the
+                # writer, which drains them in CSV order. Twice the concurrency keeps every
+                # server slot busy while the oldest batch is awaited, without holding a
+                # task per batch for the whole file.
+                window = 2 * self.max_concurrency
+                pending: Deque["asyncio.Task[List[Dict[str, Any]]]"] = deque()
+                for i in range(0, len(rows), self.batch_size):
+                    pending.append(asyncio.create_task(_bounded(rows[i:i + self.batch_size])))
+                    if len(pending) >= window:
+                        await _write_oldest()
+                while pending:
+                    await _write_oldest()
+        progress.close()
+        if done:
+            self._restore_input_order(output_csv, input_ids)
+        if failed:
+            print(f"⚠️  {failed} rows failed after retries and were not written; rerun to resume them")
+        if self.fast_path_hits:
+            print(f"⚡ {self.fast_path_hits} empty pairs skipped the LLM")
 
 
 def main() -> None:
-    extractor = OllamaFeatureExtractor()
+    logging.basicConfig(
+        level=logging.DEBUG if "--verbose" in sys.argv[1:] else logging.WARNING,
+        format="%(message)s",
+    )
+    # httpx logs every request at INFO, which would bring per-row output back
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    extractor = OllamaFeatureExtractor(
+        use_cache="--no-cache" not in sys.argv[1:],
+        prompt_style="zero" if "--zero-shot" in sys.argv[1:] else "few",
+    )
 
     for split in ["train", "valid", "test"]:
         input_file = f"{split}.csv"
         output_file = f"{split}_enriched.csv"
         if os.path.exists(input_file):
             print(f"\n🟡 Processing {split}...")
-            extractor.process_dataset(input_file, output_file)
+            extractor.process_dataset(input_file, output_file, resume="--no-resume" not in sys.argv[1:])
         else:
             print(f"⚠️  {input_file} not found, skipping...")
 
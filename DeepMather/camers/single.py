@@ -1,35 +1,136 @@
+import asyncio
+import csv
+import hashlib
+import logging
+import sqlite3
+import sys
 import pandas as pd
 import ollama
+import orjson
 from tqdm import tqdm
-import re
 import json
 import os
-from typing import Dict, Any, Tuple
+from typing import Dict, Any, List, Optional, Tuple
+
+# Per-reply diagnostics; the parsed replies are DEBUG (run with --verbose to see them)
+log = logging.getLogger(__name__)
 
 # Expected output keys for each side
 EXPECTED_KEYS = [
     "title",
 ]
 
+# Input rows read per pd.read_csv chunk, and output rows written between flushes
+CHUNK_SIZE = 1024
+FLUSH_EVERY = 50
+# Context window per request: the static system prompt (~1.5k tokens) plus a batch of
+# titles and its reply fit inside it. A fixed value keeps every request (and the preload)
+# on the same loaded context instead of the model default
+NUM_CTX = 4096
+# Output tokens allowed per pair; a normalized title pair is well under this
+NUM_PREDICT = 350
+# Stop at a closing code fence rather than letting the model ramble after the JSON
+STOP_SEQUENCES = ["\n```"]
+# Replies observed before the per-pair cap is lowered to their p95
+TUNE_AFTER = 100
+# Ollama's constrained-decoding mode for every request
+REPLY_FORMAT = "json"
+
+class PairCache:
+    """
+    Normalized (left, right) outputs keyed by a hash of the input pair, the model
+    and the prompt version.
+    Kept in memory and, when a path is given, persisted to SQLite so repeated
+    pairs across splits and reruns skip the LLM entirely.
+    """
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self._mem: Dict[str, Tuple[Dict[str, Any], Dict[str, Any]]] = {}
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, isolation_level=None)
+            self._db.execute("CREATE TABLE IF NOT EXISTS pairs (key TEXT PRIMARY KEY, value TEXT)")
+
+    @staticmethod
+    def key(left: Dict[str, Any], right: Dict[str, Any], model: str, prompt_version: str) -> str:
+        return hashlib.sha1(json.dumps([left, right, model, prompt_version], sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[Dict[str, Any], Dict[str, Any]]]:
+        if key in self._mem:
+            return self._mem[key]
+        if self._db is not None:
+            row = self._db.execute("SELECT value FROM pairs WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                left, right = json.loads(row[0])
+                self._mem[key] = (left, right)
+                return left, right
+        return None
+
+    def set(self, key: str, value: Tuple[Dict[str, Any], Dict[str, Any]]) -> None:
+        self._mem[key] = value
+        if self._db is not None:
+            self._db.execute(
+                "INSERT OR REPLACE INTO pairs (key, value) VALUES (?, ?)",
+                (key, json.dumps(value, ensure_ascii=False)),
+            )
+
+
 class OllamaFeatureExtractor:
-    def __init__(self, model_name: str = "mistral-nemo:latest") -> None:
+    def __init__(
+        self,
+        model_name: str = "mistral-nemo:12b-instruct-2407-q4_K_M",
+        max_concurrency: Optional[int] = None,
+        keep_alive: str = "24h",
+        batch_size: int = 4,
+        use_cache: bool = True,
+        cache_path: Optional[str] = ".prompt_cache.sqlite",
+        shots: int = 2,
+    ) -> None:
         self.llm_model = model_name
+        # Worked examples in the system prompt (0-4). Each one adds ~250 prefill tokens
+        # to every request; the first two cover a match and a non-match
+        self.shots = shots
+        self.system_prompt = self._build_system_prompt(shots)
+        # Part of every cache key, so editing the prompts or options never reuses old answers
+        self.prompt_version = self._prompt_version()
+        # Successful pair outputs, keyed per prompt version
+        self.cache = PairCache(cache_path) if use_cache else None
+        # Consecutive pairs sent per LLM call, so the system prompt is prefilled once per batch
+        self.batch_size = max(1, batch_size)
+        # Keep the model resident between requests and across splits; run the server
+        # with OLLAMA_MAX_LOADED_MODELS=1 so other models cannot evict it mid-job
+        self.keep_alive = keep_alive
+        # In-flight requests per dataset. Match the server's parallel slots: start
+        # `ollama serve` with OLLAMA_NUM_PARALLEL=N; the same variable is read here.
+        if max_concurrency is None:
+            max_concurrency = int(os.environ.get("OLLAMA_NUM_PARALLEL", 8))
+        self.max_concurrency = max_concurrency
+        # Per-pair output cap, lowered once TUNE_AFTER replies have been seen
+        self.num_predict = NUM_PREDICT
+        self._output_tokens: List[float] = []
+        # Pairs answered without the LLM because both titles were blank (per dataset)
+        self.fast_path_hits = 0
 
 
     def normalize_llm_output(self, response: Dict[str, Any]) -> Dict[str, Any]:
-        """Ensure all expected keys exist, map variants, and coerce types."""
-        key_map = {
-            "title": "title",
-        }
-        normalized: Dict[str, Any] = {}
-        for key, value in response.items():
-            std_key = key_map.get(key, key)
-            normalized[std_key] = value
-        return normalized
+        """Project a reply onto the fixed schema; a missing title is written as an empty cell."""
+        return {"title": response.get("title", "")}
 
     # -------------------- LLM prompt (pair) --------------------
-    def _build_pair_prompt(self, left: Dict[str, Any], right: Dict[str, Any]) -> str:
-        return f"""
+    # Everything that does not depend on the row (rules, schema, few-shot examples,
+    # output guard) goes in the system message, built once at class load. Every
+    # request then starts with the same bytes, so the server can reuse its KV cache
+    # for that prefix and only prefill the two titles in the user message.
+    _SYSTEM_GUARD = (
+        "You are entity matcher for the ditto. Do not explain. "
+        "Do not describe anything. Do not say 'Output:' or '<think>'. "
+        "Do not provide reasoning, steps, formatting explanation, or notes. "
+        "Output exactly one compact JSON object in the shape asked for, with keys 'left' and 'right' for each pair. "
+        "PRESERVE ORIGINAL CASE. Do NOT change to title case. Do not capitalize words unless already capitalized. "
+        "No headings. No thoughts. No prose. No code fences. No Markdown. "
+        "If you violate this, your output will be rejected."
+    )
+    _RULES = _SYSTEM_GUARD + """
 You are a data normalization expert. Your job is to clean and standardize structured data records for entity matching:
 
 You are a data normalization expert. Clean and standardize TWO structured camera records at once.
@@ -72,21 +173,23 @@ Remove promotional terms (e.g., “Black Friday Deal”, “Hot Buy”)
 
 
 Output JSON schema (MUST follow):
-{{
-  "left": {{
+{
+  "left": {
     "title": string,
-  }},
-  "right": {{
+  },
+  "right": {
     "title": string
-  }}
-}}
+  }
+}
 
 
----
-## FEW‑SHOT EXAMPLES ( nested left/right)
-
-### Example 1: Same product, unify titles
-Left input:
+"""
+    # Worked examples, in the order they are kept when `shots` trims the list:
+    # a match and a same-brand non-match come first
+    _FEW_SHOTS = [
+        (
+            'Same product, unify titles',
+            """Left input:
 left_title: "Canon EF 70-300mm f/4-5.6 IS II USM Telephoto Zoom Lens"@en "by Canon | Amazon.com"
 
 Right input:
@@ -95,18 +198,42 @@ right_title: "Canon 70-300mm IS II USM Lens EF Mount"@en "Canon Lens for EOS SLR
 label: 1
 
 **Standardized Output:**
-{{
-  "left": {{
+{
+  "left": {
     "title": "Canon EF 70-300mm f/4-5.6 IS II Ultrasonic Motor Telephoto Zoom Lens"
-  }},
-  "right": {{
+  },
+  "right": {
     "title": "Canon EF 70-300mm f/4-5.6 IS II Ultrasonic Motor Telephoto Zoom Lens"
-  }}
-}}
+  }
+}
+
+""",
+        ),
+        (
+            'Different Canon camera models',
+            """Left input:
+left_title: "Canon EOS 90D DSLR Camera with 18-135mm IS USM Lens"@en
 
----
-### Example 2: Bundle phrased differently (may still converge)
-Left input:
+Right input:
+right_title: "Canon EOS Rebel T7 with 18-55mm Lens Kit for Beginners"@en
+
+label: 0
+
+**Standardized Output:**
+{
+  "left": {
+    "title": "Canon EOS 90D DSLR Camera with 18-135mm IS Ultrasonic Motor Lens"
+  },
+  "right": {
+    "title": "Canon EOS Rebel T7 DSLR Camera with 18-55mm Lens Kit"
+  }
+}
+
+""",
+        ),
+        (
+            'Bundle phrased differently (may still converge)',
+            """Left input:
 left_title: "GoPro HERO9 Black Bundle with Extra Battery + Tripod Mount"@en-US "@MediaMarkt NL"
 
 Right input:
@@ -115,18 +242,20 @@ right_title: "GoPro HERO9 Black Edition Camera Kit with Battery and Mount"@en
 label: 0
 
 **Standardized Output:**
-{{
-  "left": {{
+{
+  "left": {
     "title": "GoPro HERO9 Black Camera Kit with Extra Battery and Tripod Mount"
-  }},
-  "right": {{
+  },
+  "right": {
     "title": "GoPro HERO9 Black Camera Kit with Extra Battery and Tripod Mount"
-  }}
-}}
-
----
-### Example 3: Clearly different products (different brands/specs)
-Left input:
+  }
+}
+
+""",
+        ),
+        (
+            'Clearly different products (different brands/specs)',
+            """Left input:
 left_title: "Intel Solid-State Drive 540S Series - solid state drive 240 GB SATA 6Gb Intel 6Gb SSDSCKKW240H6X1 Solid State Drives (SSDs) CDW.com"
 
 Right input:
@@ -135,51 +264,25 @@ right_title: "Samsung 850 EVO Series M.2 1TB SATA 6Gbps Solid State Drive (MZ-N5
 label: 0
 
 **Standardized Output:**
-{{
-  "left": {{
+{
+  "left": {
     "title": "Intel 540S Series 240GB SATA 6Gbps SSD SSDSCKKW240H6X1"
-  }},
-  "right": {{
+  },
+  "right": {
     "title": "Samsung 850 EVO Series 1TB M.2 SATA 6Gbps SSD MZ-N5E1T0BW"
-  }}
-}}
+  }
+}
 
----
-### Example 4: Different Canon camera models
-Left input:
-left_title: "Canon EOS 90D DSLR Camera with 18-135mm IS USM Lens"@en
-
-Right input:
-right_title: "Canon EOS Rebel T7 with 18-55mm Lens Kit for Beginners"@en
-
-label: 0
-
-**Standardized Output:**
-{{
-  "left": {{
-    "title": "Canon EOS 90D DSLR Camera with 18-135mm IS Ultrasonic Motor Lens"
-  }},
-  "right": {{
-    "title": "Canon EOS Rebel T7 DSLR Camera with 18-55mm Lens Kit"
-  }}
-}}
-
-____________ End of Examples ----------
-
-
-Now process this record:
-
-Left record input:
-{json.dumps(left.get("title", ""), ensure_ascii=False)}
-
-Right record input:
-{json.dumps(right.get("title", ""), ensure_ascii=False)}
+""",
+        ),
+    ]
+    _OUTPUT_RULES = """
 
 📘 Output JSON schema (always follow):
-{{
-  "left":  {{"title": string}},
-  "right": {{"title": string}}
-}}
+{
+  "left":  {"title": string},
+  "right": {"title": string}
+}
 
 ⚠️ OUTPUT RULES — STRICTLY FOLLOW:
 - Output must be valid JSON.
@@ -189,83 +292,339 @@ Right record input:
 
 """
 
-    def extract_pair_standardized_attributes(
-        self, left_record: Dict[str, Any], right_record: Dict[str, Any]
-    ) -> Tuple[Dict[str, Any], Dict[str, Any]]:
-        prompt = self._build_pair_prompt(left_record, right_record)
+    def _build_system_prompt(self, shots: int) -> str:
+        """Rules, the first `shots` worked examples, then the output rules."""
+        examples = self._FEW_SHOTS[:shots]
+        if not examples:
+            return self._RULES + self._OUTPUT_RULES
+        worked = "---\n".join(
+            f"### Example {i}: {title}\n{example}" for i, (title, example) in enumerate(examples, 1)
+        )
+        return (
+            self._RULES
+            + "---\n## FEW‑SHOT EXAMPLES ( nested left/right)\n\n"
+            + worked
+            + "____________ End of Examples ----------\n"
+            + self._OUTPUT_RULES
+        )
+
+    def _is_trivial(self, record: Dict[str, Any]) -> bool:
+        """True when every field of a record is missing or blank."""
+        for value in record.values():
+            if pd.notna(value) and str(value).strip():
+                return False
+        return True
+
+    # Per-request text around the JSON-encoded titles; only the holes change per call
+    _PAIR_TEMPLATE = "Left record input:\n{left_json}\n\nRight record input:\n{right_json}"
+    # The batch shape is spelled out here rather than in the system message,
+    # so the shared system prefix stays the same for single pairs and batches
+    _BATCH_TEMPLATE = (
+        "Normalize these {n} record pairs, given as a JSON array:\n"
+        "{records_json}\n\n"
+        'Return a JSON object {{"results": [...]}} whose array holds exactly {n} objects, '
+        'each {{"left": {{"title": string}}, "right": {{"title": string}}}}, in the same order as idx.'
+    )
+
+    def _build_user_payload(self, left: Dict[str, Any], right: Dict[str, Any]) -> str:
+        return self._PAIR_TEMPLATE.format(
+            left_json=orjson.dumps(left.get("title", "")).decode(),
+            right_json=orjson.dumps(right.get("title", "")).decode(),
+        )
+
+    def _build_batch_payload(self, pairs: List[Tuple[Dict[str, Any], Dict[str, Any]]]) -> str:
+        records = [
+            {"idx": i, "left": {"title": left.get("title", "")}, "right": {"title": right.get("title", "")}}
+            for i, (left, right) in enumerate(pairs)
+        ]
+        return self._BATCH_TEMPLATE.format(n=len(pairs), records_json=orjson.dumps(records).decode())
+
+    def _prompt_version(self) -> str:
+        """
+        Hash of everything besides the titles that shapes a reply: the system prompt,
+        the single and batch user payloads (rendered around an empty probe pair), the
+        fixed request options and the reply format. The tuned num_predict is left out.
+        """
+        probe = {"title": ""}
+        payload = json.dumps(
+            [
+                self.system_prompt,
+                self._build_user_payload(probe, probe),
+                self._build_batch_payload([(probe, probe)] * 2),
+                {"temperature": 0.0, "num_ctx": NUM_CTX, "stop": STOP_SEQUENCES},
+                REPLY_FORMAT,
+            ]
+        )
+        return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+    def preload_model(self) -> None:
+        """
+        Load the model and prefill the static system prompt once up front. Later requests
+        share that prefix, so Ollama reuses its KV state instead of evaluating it per pair.
+        """
         try:
-            response = ollama.chat(
+            ollama.chat(
                 model=self.llm_model,
-                options={"temperature": 0.0, "num_predict": 2000},
+                keep_alive=self.keep_alive,
+                options={"temperature": 0.0, "num_predict": 1, "num_ctx": NUM_CTX},
                 messages=[
-                    {
-                        "role": "system",
-                        "content": (
-                            "You are entity matcher for the ditto. Do not explain. "
-                            "Do not describe anything. Do not say 'Output:' or '<think>'. "
-                            "Do not provide reasoning, steps, formatting explanation, or notes. "
-                            "Return EXACTLY one line with TWO transformed records separated by ONE real tab character. PRESERVE ORIGINAL CASE. Do NOT change to title case. Do not capitalize words unless already capitalized. "
-                            "No headings. No thoughts. No multiple lines. No Markdown. No JSON. Only raw string output. "
-                            "If you violate this, your output will be rejected."
-                        )
-                    },
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
+                    {"role": "system", "content": self.system_prompt},
+                    {"role": "user", "content": ""},
                 ],
             )
-            content = response["message"]["content"].strip()
-            if content.startswith("```"):
-                content = re.sub(r"^```[a-zA-Z]*\n?", "", content)
-                content = re.sub(r"```$", "", content).strip()
-            parsed = json.loads(content)
-            print("passed",parsed)
+        except Exception as e:
+            log.warning("⚠️  Could not preload %s: %s", self.llm_model, e)
+
+    async def _chat(self, client: ollama.AsyncClient, prompt: str, num_predict: int) -> Any:
+        # JSON mode constrains sampling to valid JSON, so replies carry no fences or prose
+        return await client.chat(
+            model=self.llm_model,
+            format=REPLY_FORMAT,
+            keep_alive=self.keep_alive,
+            options={"temperature": 0.0, "num_predict": num_predict, "num_ctx": NUM_CTX, "stop": STOP_SEQUENCES},
+            messages=[
+                {
+                    "role": "system",
+                    "content": self.system_prompt
+                },
+                {
+                    "role": "user",
+                    "content": prompt
+                }
+            ],
+        )
+
+    async def _chat_content(self, client: ollama.AsyncClient, prompt: str, n_pairs: int = 1) -> str:
+        """Chat with an output cap sized for n_pairs; a reply cut off by a tuned cap is retried at the full cap."""
+        response = await self._chat(client, prompt, self.num_predict * n_pairs)
+        if response.get("done_reason") == "length" and self.num_predict < NUM_PREDICT:
+            response = await self._chat(client, prompt, NUM_PREDICT * n_pairs)
+        if response.get("done_reason") != "length" and response.get("eval_count"):
+            self._record_output_tokens(response["eval_count"] / n_pairs)
+        return response["message"]["content"].strip()
+
+    def _record_output_tokens(self, tokens_per_pair: float) -> None:
+        """Lower the per-pair cap to the p95 of the first TUNE_AFTER replies (never above NUM_PREDICT)."""
+        if len(self._output_tokens) >= TUNE_AFTER:
+            return
+        self._output_tokens.append(tokens_per_pair)
+        if len(self._output_tokens) == TUNE_AFTER:
+            p95 = sorted(self._output_tokens)[int(0.95 * (TUNE_AFTER - 1))]
+            # A little headroom so the retry at the full cap stays rare
+            self.num_predict = min(NUM_PREDICT, int(p95 * 1.1) + 1)
+            log.info("🎚️  num_predict tuned to %d tokens per pair (p95 %.0f)", self.num_predict, p95)
+
+    @staticmethod
+    def parse_json(content: str) -> Any:
+        """
+        Parse the outermost JSON object or array in an LLM reply. Slicing from the first
+        bracket to the last matching one drops code fences and stray prose around it.
+        """
+        # JSON-mode replies are already bare JSON; only other replies are scanned
+        starts = []
+        if not (content.startswith(("{", "[")) and content.endswith(("}", "]"))):
+            starts = [i for i in (content.find("{"), content.find("[")) if i != -1]
+        if starts:
+            start = min(starts)
+            end = content.rfind("}" if content[start] == "{" else "]")
+            if end > start:
+                content = content[start:end + 1]
+        try:
+            return orjson.loads(content)
+        except orjson.JSONDecodeError:
+            # json also accepts NaN/Infinity, which orjson rejects
+            return json.loads(content)
+
+    async def _try_pair(
+        self, client: ollama.AsyncClient, left_record: Dict[str, Any], right_record: Dict[str, Any]
+    ) -> Optional[Tuple[Dict[str, Any], Dict[str, Any]]]:
+        """One LLM call for one pair; None when the reply cannot be used."""
+        prompt = self._build_user_payload(left_record, right_record)
+        content = None
+        try:
+            content = await self._chat_content(client, prompt)
+            parsed = self.parse_json(content)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("passed %s", parsed)
             left_out = self.normalize_llm_output(parsed.get("left", {}))
             right_out = self.normalize_llm_output(parsed.get("right", {}))
             return left_out, right_out
         except json.JSONDecodeError as jde:
-            print(f"❌ JSON decode error: {jde}")
-            print("⚠️ Content that failed parsing:", content if 'content' in locals() else None)
-            # Fallback to empty normalized objects
-            return self.normalize_llm_output({}), self.normalize_llm_output({})
+            # Only a reply cut off at the output cap gets here in JSON mode
+            log.warning("❌ JSON decode error: %s", jde)
+            log.warning("⚠️ Content that failed parsing: %s", content)
         except Exception as e:
-            print(f"❌ Unexpected error: {e}")
-            return self.normalize_llm_output({}), self.normalize_llm_output({})
+            log.warning("❌ Unexpected error: %s", e)
+        return None
 
-    # -------------------- Dataset utilities --------------------
-    def split_record(self, row: Dict[str, Any], side: str) -> Dict[str, Any]:
-        return {col[len(f"{side}_"):]: row[col] for col in row if col.startswith(f"{side}_")}
+    async def _extract_llm(
+        self, client: ollama.AsyncClient, pairs: List[Tuple[Dict[str, Any], Dict[str, Any]]]
+    ) -> List[Optional[Tuple[Dict[str, Any], Dict[str, Any]]]]:
+        """One LLM call for all pairs; a malformed batch answer falls back to one call per pair."""
+        if len(pairs) == 1:
+            return [await self._try_pair(client, *pairs[0])]
 
-    def process_dataset(self, input_csv: str, output_csv: str) -> None:
-        print(f"📄 Reading data from {input_csv}...")
-        df = pd.read_csv(input_csv)
-        all_rows = []
+        prompt = self._build_batch_payload(pairs)
+        try:
+            content = await self._chat_content(client, prompt, len(pairs))
+            parsed = self.parse_json(content)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("passed %s", parsed)
+            if isinstance(parsed, dict):
+                parsed = parsed.get("results")
+            if not isinstance(parsed, list) or len(parsed) != len(pairs):
+                raise ValueError(f"expected {len(pairs)} results")
+            return [
+                (self.normalize_llm_output(item.get("left", {})), self.normalize_llm_output(item.get("right", {})))
+                for item in parsed
+            ]
+        except Exception as e:
+            log.warning("❌ Batch error: %s; retrying %d pairs one by one", e, len(pairs))
+            return [await self._try_pair(client, left_record, right_record) for left_record, right_record in pairs]
+
+    async def extract_pair_standardized_attributes(
+        self, client: ollama.AsyncClient, left_record: Dict[str, Any], right_record: Dict[str, Any]
+    ) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        return (await self.extract_batch_standardized_attributes(client, [(left_record, right_record)]))[0]
+
+    async def extract_batch_standardized_attributes(
+        self, client: ollama.AsyncClient, pairs: List[Tuple[Dict[str, Any], Dict[str, Any]]]
+    ) -> List[Tuple[Dict[str, Any], Dict[str, Any]]]:
+        """
+        Normalize several pairs with one LLM call. Cached pairs skip the LLM;
+        pairs that fail come back as empty normalized objects and are not cached.
+        """
+        results: List[Optional[Tuple[Dict[str, Any], Dict[str, Any]]]] = [None] * len(pairs)
+        keys: List[Optional[str]] = [None] * len(pairs)
+        misses = []
+        for i, (left_record, right_record) in enumerate(pairs):
+            if self._is_trivial(left_record) and self._is_trivial(right_record):
+                # Nothing to normalize: both titles are written as empty cells
+                results[i] = (self.normalize_llm_output({}), self.normalize_llm_output({}))
+                self.fast_path_hits += 1
+                continue
+            if self.cache is not None:
+                keys[i] = PairCache.key(left_record, right_record, self.llm_model, self.prompt_version)
+                results[i] = self.cache.get(keys[i])
+            if results[i] is None:
+                misses.append(i)
+
+        if misses:
+            cleaned = await self._extract_llm(client, [pairs[i] for i in misses])
+            for i, pair_out in zip(misses, cleaned):
+                if pair_out is None:
+                    # Fallback to empty normalized objects
+                    pair_out = (self.normalize_llm_output({}), self.normalize_llm_output({}))
+                elif keys[i] is not None:
+                    self.cache.set(keys[i], pair_out)
+                results[i] = pair_out
+        return results
 
-        for _, row in tqdm(df.iterrows(), total=len(df)):
-            row_dict = row.to_dict()
-            left_input = self.split_record(row_dict, "left")
-            right_input = self.split_record(row_dict, "right")
+    # -------------------- Dataset utilities --------------------
+    def split_columns(self, columns: List[str], side: str) -> List[Tuple[str, str]]:
+        """Map each `{side}_*` column to its bare key; computed once per CSV."""
+        prefix = f"{side}_"
+        return [(col, col[len(prefix):]) for col in columns if col.startswith(prefix)]
 
-            left_cleaned, right_cleaned = self.extract_pair_standardized_attributes(left_input, right_input)
+    def side_records(self, df: pd.DataFrame, side: str) -> List[Dict[str, Any]]:
+        """One dict per row holding that side's fields under their bare keys."""
+        cols = self.split_columns(list(df.columns), side)
+        return df[[col for col, _ in cols]].set_axis([key for _, key in cols], axis=1).to_dict("records")
 
-            new_row: Dict[str, Any] = {
-                "id": row_dict.get("id"),
-                "label": row_dict.get("label"),
-            }
-            for k, v in left_cleaned.items():
-                new_row[f"left_{k}"] = v
-            for k, v in right_cleaned.items():
-                new_row[f"right_{k}"] = v
-            all_rows.append(new_row)
+    def process_dataset(self, input_csv: str, output_csv: str) -> None:
+        asyncio.run(self._process_dataset(input_csv, output_csv))
 
-        enriched_df = pd.DataFrame(all_rows)
-        print(f"💾 Saving enriched data to {output_csv}")
-        enriched_df.to_csv(output_csv, index=False)
+    async def _process_dataset(self, input_csv: str, output_csv: str) -> None:
+        print(f"📄 Reading data from {input_csv}...")
 
+        sem = asyncio.Semaphore(self.max_concurrency)
+        # Counts written rows and advances once per flush rather than once per row
+        progress = tqdm(unit="rows")
+
+        async def _bounded(
+            pairs: List[Tuple[Dict[str, Any], Dict[str, Any]]]
+        ) -> List[Tuple[Dict[str, Any], Dict[str, Any]]]:
+            async with sem:
+                return await self.extract_batch_standardized_attributes(client, pairs)
+
+        fieldnames = ["id", "label"] + [f"left_{k}" for k in EXPECTED_KEYS] + [f"right_{k}" for k in EXPECTED_KEYS]
+        print(f"💾 Streaming enriched data to {output_csv}")
+        written = 0
+        duplicates = 0
+        self.fast_path_hits = 0
+        # The client is bound to this event loop, so it is opened and closed with the
+        # dataset run rather than left for the garbage collector
+        async with ollama.AsyncClient() as client:
+            with open(output_csv, "w", newline="", encoding="utf-8") as f:
+                writer = csv.DictWriter(f, fieldnames=fieldnames, restval="", extrasaction="ignore", lineterminator="\n")
+                writer.writeheader()
+                # Input is read in chunks and output written as it completes, so memory
+                # stays bounded by the chunk size rather than the dataset. Every column is
+                # read as text: ids and labels are written back unchanged and titles go to
+                # the model as strings, so per-chunk type inference buys nothing
+                for df in pd.read_csv(input_csv, chunksize=CHUNK_SIZE, dtype=str, engine="c"):
+                    # Each side is sliced and converted in one pass instead of scanning every
+                    # column of every row
+                    missing = [None] * len(df)
+                    records = list(zip(
+                        df["id"].tolist() if "id" in df.columns else missing,
+                        df["label"].tolist() if "label" in df.columns else missing,
+                        self.side_records(df, "left"),
+                        self.side_records(df, "right"),
+                    ))
+                    # Identical pairs within the chunk are sent once; slot[i] is row i's
+                    # index into the unique pairs
+                    unique: Dict[str, int] = {}
+                    pairs: List[Tuple[Dict[str, Any], Dict[str, Any]]] = []
+                    slot: List[int] = []
+                    for _, _, left_input, right_input in records:
+                        pair_key = PairCache.key(left_input, right_input, self.llm_model, self.prompt_version)
+                        if pair_key not in unique:
+                            unique[pair_key] = len(pairs)
+                            pairs.append((left_input, right_input))
+                        slot.append(unique[pair_key])
+                    duplicates += len(records) - len(pairs)
+
+                    # Consecutive unique pairs go out in batches, all in flight at once;
+                    # rows are written back in CSV order
+                    tasks = [
+                        asyncio.create_task(_bounded(pairs[i:i + self.batch_size]))
+                        for i in range(0, len(pairs), self.batch_size)
+                    ]
+                    for (row_id, label, _, _), pair_slot in zip(records, slot):
+                        batch_no, pos = divmod(pair_slot, self.batch_size)
+                        left_cleaned, right_cleaned = (await tasks[batch_no])[pos]
+                        new_row: Dict[str, Any] = {
+                            "id": row_id,
+                            "label": label,
+                        }
+                        # NaN values are written as empty cells, as DataFrame.to_csv did
+                        for k, v in left_cleaned.items():
+                            new_row[f"left_{k}"] = None if isinstance(v, float) and v != v else v
+                        for k, v in right_cleaned.items():
+                            new_row[f"right_{k}"] = None if isinstance(v, float) and v != v else v
+                        writer.writerow(new_row)
+                        written += 1
+                        if written % FLUSH_EVERY == 0:
+                            f.flush()
+                            progress.set_postfix(blank_pairs=self.fast_path_hits, refresh=False)
+                            progress.update(FLUSH_EVERY)
+        progress.update(written % FLUSH_EVERY)
+        progress.close()
+        if duplicates:
+            print(f"🔁 {duplicates} duplicate pairs reused an earlier result")
+        if self.fast_path_hits:
+            print(f"⚡ {self.fast_path_hits} blank pairs skipped the LLM")
 
 def main() -> None:
+    logging.basicConfig(
+        level=logging.DEBUG if "--verbose" in sys.argv[1:] else logging.INFO,
+        format="%(message)s",
+    )
+    # httpx logs every request at INFO, which would bring per-row output back
+    logging.getLogger("httpx").setLevel(logging.WARNING)
     extractor = OllamaFeatureExtractor()
+    extractor.preload_model()
 
     for split in ["train", "valid", "test"]:
         input_file = f"{split}.csv"
@@ -3,8 +3,12 @@ import ollama
 from tqdm import tqdm
 import re
 import json
+import orjson
 import os
-from typing import Dict, Any, Tuple
+import sys
+import csv
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Any, List, Tuple
  
 # Expected output keys for each side
 EXPECTED_KEYS = [
@@ -19,33 +23,46 @@ EXPECTED_KEYS = [
     
 ]
 
+# Output column names, interned and built once instead of formatted per row
+LEFT_COLS = [sys.intern(f"left_{k}") for k in EXPECTED_KEYS]
+RIGHT_COLS = [sys.intern(f"right_{k}") for k in EXPECTED_KEYS]
+
+# Code-fence patterns stripped from model responses
+FENCE_OPEN_RE = re.compile(r"^```[a-zA-Z]*\n?")
+FENCE_CLOSE_RE = re.compile(r"```$")
+
 class OllamaFeatureExtractor:
-    def __init__(self, model_name: str = "mistral-nemo:latest") -> None:
+    def __init__(
+        self,
+        model_name: str = "mistral-nemo:latest",
+        max_workers: int = 8,
+        host: str = None,
+        timeout: float = 120,
+    ) -> None:
         self.llm_model = model_name
+        # Concurrent chat requests; keep <= OLLAMA_NUM_PARALLEL on the server
+        self.max_workers = max_workers
+        # One persistent client so every request (and worker thread) reuses the
+        # same keep-alive connection pool; host=None falls back to OLLAMA_HOST
+        self.client = ollama.Client(host=host, timeout=timeout)
+
 
+    # Variant key -> standard key. Every entry used to be an identity mapping,
+    # so it is empty until a real variant needs mapping.
+    _KEY_VARIANTS: Dict[str, str] = {}
 
     def normalize_llm_output(self, response: Dict[str, Any]) -> Dict[str, Any]:
-        """Ensure all expected keys exist, map variants, and coerce types."""
-        key_map = {
-            "title": "title",
-            "Song_Name":"Song_Name",
-            "Artist_Name": "Artist_Name",
-            "Album_Name":"Album_Name",
-            "Genre":"Genre",
-            "Price":"Price",
-            "CopyRight":"CopyRight",
-            "Time":"Time",
-            "Released" : "Released"
-        }
-        normalized: Dict[str, Any] = {}
-        for key, value in response.items():
-            std_key = key_map.get(key, key)
-            normalized[std_key] = value
-        return normalized
+        """Map key variants to the standard names; a no-op while there are none."""
+        if not isinstance(response, dict):
+            raise TypeError(f"expected a JSON object, got {type(response).__name__}")
+        if not self._KEY_VARIANTS:
+            return response
+        return {self._KEY_VARIANTS.get(key, key): value for key, value in response.items()}
 
     # -------------------- LLM prompt (pair) --------------------
-    def _build_pair_prompt(self, left: Dict[str, Any], right: Dict[str, Any]) -> str:
-        return f"""
+    # Static scaffold (rules, schema, few-shot examples) built once at class load;
+    # only the two record blobs are formatted per call.
+    _PROMPT_PREFIX = """
 You are a data normalization expert. Your job is to clean and standardize structured data records for entity matching:
 
 You are a data normalization expert. Clean and standardize TWO structured camera records at once.
@@ -89,8 +106,8 @@ Remove promotional terms (e.g., “Black Friday Deal”, “Hot Buy”)
 
 Output JSON schema (MUST follow):
 
-{{
-  "left": {{
+{
+  "left": {
     "Song_Name": string,
     "Artist_Name": string,
     "Album_Name": string,
@@ -99,8 +116,8 @@ Output JSON schema (MUST follow):
     "CopyRight": string,
     "Time": string,
     "Released": string
-  }},
-  "right": {{
+  },
+  "right": {
     "Song_Name": string,
     "Artist_Name": string,
     "Album_Name": string,
@@ -109,8 +126,8 @@ Output JSON schema (MUST follow):
     "CopyRight": string,
     "Time": string,
     "Released": string
-  }}
-}}
+  }
+}
 
 
 ------
@@ -141,8 +158,8 @@ Released: "May 18, 2015"
 label: 1
 
 **Standardized Output:**
-{{
-    "left": {{
+{
+    "left": {
     "Song_Name": "Illusion (feat. Echosmith)",
     "Artist_Name": "Zedd",
     "Album_Name": "True Colors",
@@ -151,8 +168,8 @@ label: 1
     "CopyRight": "2015 Interscope Records",
     "Time": "06:30",
     "Released": "2015-05-18"
-  }},
-  "right": {{
+  },
+  "right": {
     "Song_Name": "Illusion (feat. Echosmith)",
     "Artist_Name": "Zedd",
     "Album_Name": "True Colors",
@@ -161,8 +178,8 @@ label: 1
     "CopyRight": "(C) 2015 Interscope Records (C) (copyright)",
     "Time": "06:30",
     "Released": "2015-05-18"
-  }}
-}}
+  }
+}
 
 ---
 Example 2 — Same track, explicit feature & (C); label = 1
@@ -190,8 +207,8 @@ Released: "2015-05-18"
 label: 0
 
 **Standardized Output:**
-{{
-  "left": {{
+{
+  "left": {
     "Song_Name": "Transmission (feat. X Ambassadors)",
     "Artist_Name": "Zedd",
     "Album_Name": "True Colors",
@@ -200,8 +217,8 @@ label: 0
     "CopyRight": "(C) 2015 Interscope Records (C) (copyright)",
     "Time": "04:02",
     "Released": "2015-05-18"
-  }},
-  "right": {{
+  },
+  "right": {
     "Song_Name": "Transmission (feat. X Ambassadors)",
     "Artist_Name": "Zedd",
     "Album_Name": "True Colors",
@@ -210,8 +227,8 @@ label: 0
     "CopyRight": "(C) 2015 Interscope Records (C) (copyright)",
     "Time": "04:02",
     "Released": "2015-05-18"
-  }}
-}}
+  }
+}
 
 ---
 Example 3 — Different songs; label = 0
@@ -240,8 +257,8 @@ Released: ""
 label: 0
 
 **Standardized Output:**
-{{
-  "left": {{
+{
+  "left": {
     "Song_Name": "Titanium (feat. Sia)",
     "Artist_Name": "David Guetta",
     "Album_Name": "Listen (Deluxe Version)",
@@ -250,8 +267,8 @@ label: 0
     "CopyRight": "© 2011 What A Music Ltd",
     "Time": "04:02",
     "Released": "2011-08-26"
-  }},
-  "right": {{
+  },
+  "right": {
     "Song_Name": "Still Down [Explicit]",
     "Artist_Name": "Zedd",
     "Album_Name": "True Colors",
@@ -260,8 +277,8 @@ label: 0
     "CopyRight": "VAL -",
     "Time": "03:29",
     "Released": "VAL -"
-  }}
-}}
+  }
+}
 
 ____________ End of Examples ----------
 
@@ -269,14 +286,13 @@ ____________ End of Examples ----------
 Now process this record:
 
 Left record input:
-{json.dumps(left, ensure_ascii=False, indent=2)}
+"""
 
-Right record input:
-{json.dumps(right, ensure_ascii=False, indent=2)}
+    _PROMPT_SUFFIX = """
 
 ##Output JSON schema (always follow):
-{{
-  "left": {{
+{
+  "left": {
     "Song_Name": string,
     "Artist_Name": string,
     "Album_Name": string,
@@ -285,8 +301,8 @@ Right record input:
     "CopyRight": string,
     "Time": string,
     "Released": string
-  }},
-  "right": {{
+  },
+  "right": {
     "Song_Name": string,
     "Artist_Name": string,
     "Album_Name": string,
@@ -295,8 +311,8 @@ Right record input:
     "CopyRight": string,
     "Time": string,
     "Released": string
-  }}
-}}
+  }
+}
 
 ⚠️ OUTPUT RULES — STRICTLY FOLLOW
 - Return values exactly as strings; format Price as `USD X.XX`, Time as `MM:SS`, Released as `YYYY-MM-DD`, and use `VAL -` when unknown.
@@ -309,12 +325,21 @@ Right record input:
 
 """
 
+    def _build_pair_prompt(self, left: Dict[str, Any], right: Dict[str, Any]) -> str:
+        return (
+            self._PROMPT_PREFIX
+            + orjson.dumps(left).decode()
+            + "\n\nRight record input:\n"
+            + orjson.dumps(right).decode()
+            + self._PROMPT_SUFFIX
+        )
+
     def extract_pair_standardized_attributes(
         self, left_record: Dict[str, Any], right_record: Dict[str, Any]
     ) -> Tuple[Dict[str, Any], Dict[str, Any]]:
         prompt = self._build_pair_prompt(left_record, right_record)
         try:
-            response = ollama.chat(
+            response = self.client.chat(
                 model=self.llm_model,
                 options={"temperature": 0.0, "num_predict": 2000},
                 messages=[
@@ -337,9 +362,10 @@ Right record input:
             )
             content = response["message"]["content"].strip()
             if content.startswith("```"):
-                content = re.sub(r"^```[a-zA-Z]*\n?", "", content)
-                content = re.sub(r"```$", "", content).strip()
-            parsed = json.loads(content)
+                content = FENCE_OPEN_RE.sub("", content)
+                content = FENCE_CLOSE_RE.sub("", content).strip()
+            # orjson.JSONDecodeError subclasses json.JSONDecodeError, so the handler below still applies
+            parsed = orjson.loads(content)
             print("passed",parsed)
             left_out = self.normalize_llm_output(parsed.get("left", {}))
             right_out = self.normalize_llm_output(parsed.get("right", {}))
@@ -348,40 +374,63 @@ Right record input:
             print(f"❌ JSON decode error: {jde}")
             print("⚠️ Content that failed parsing:", content if 'content' in locals() else None)
             # Fallback to empty normalized objects
-            return self.normalize_llm_output({}), self.normalize_llm_output({})
+            return {}, {}
         except Exception as e:
             print(f"❌ Unexpected error: {e}")
-            return self.normalize_llm_output({}), self.normalize_llm_output({})
+            return {}, {}
 
     # -------------------- Dataset utilities --------------------
-    def split_record(self, row: Dict[str, Any], side: str) -> Dict[str, Any]:
-        return {col[len(f"{side}_"):]: row[col] for col in row if col.startswith(f"{side}_")}
+    def split_columns(self, columns: List[str], side: str) -> List[Tuple[str, str]]:
+        """Map each `{side}_*` column to its bare key; computed once per CSV."""
+        prefix = f"{side}_"
+        return [(col, col[len(prefix):]) for col in columns if col.startswith(prefix)]
 
     def process_dataset(self, input_csv: str, output_csv: str) -> None:
         print(f"📄 Reading data from {input_csv}...")
         df = pd.read_csv(input_csv)
-        all_rows = []
 
-        for _, row in tqdm(df.iterrows(), total=len(df)):
-            row_dict = row.to_dict()
-            left_input = self.split_record(row_dict, "left")
-            right_input = self.split_record(row_dict, "right")
+        left_cols = self.split_columns(list(df.columns), "left")
+        right_cols = self.split_columns(list(df.columns), "right")
+
+        pairs: List[Tuple[Any, Any, Dict[str, Any], Dict[str, Any]]] = []
+        for row_dict in df.to_dict(orient="records"):
+            left_input = {key: row_dict[col] for col, key in left_cols}
+            right_input = {key: row_dict[col] for col, key in right_cols}
+            pairs.append((row_dict.get("id"), row_dict.get("label"), left_input, right_input))
 
-            left_cleaned, right_cleaned = self.extract_pair_standardized_attributes(left_input, right_input)
+        # Fixed header so rows can be written as soon as they are ready
+        fieldnames = ["id", "label"] + LEFT_COLS + RIGHT_COLS
 
-            new_row: Dict[str, Any] = {
-                "id": row_dict.get("id"),
-                "label": row_dict.get("label"),
+        print(f"💾 Streaming enriched data to {output_csv}")
+        with open(output_csv, "w", newline="", encoding="utf-8") as f, \
+                ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            writer = csv.DictWriter(f, fieldnames=fieldnames, restval="", extrasaction="ignore", lineterminator="\n")
+            writer.writeheader()
+
+            # LLM calls are I/O-bound, so overlap them; results are keyed by position to keep row order
+            futures = {
+                executor.submit(self.extract_pair_standardized_attributes, left_input, right_input): i
+                for i, (_, _, left_input, right_input) in enumerate(pairs)
             }
-            for k, v in left_cleaned.items():
-                new_row[f"left_{k}"] = v
-            for k, v in right_cleaned.items():
-                new_row[f"right_{k}"] = v
-            all_rows.append(new_row)
-
-        enriched_df = pd.DataFrame(all_rows)
-        print(f"💾 Saving enriched data to {output_csv}")
-        enriched_df.to_csv(output_csv, index=False)
+            pending: Dict[int, Tuple[Dict[str, Any], Dict[str, Any]]] = {}
+            next_i = 0
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                pending[futures[future]] = future.result()
+                # Write every row whose predecessors are done, then drop it
+                while next_i in pending:
+                    left_cleaned, right_cleaned = pending.pop(next_i)
+                    row_id, label, _, _ = pairs[next_i]
+
+                    new_row: Dict[str, Any] = {
+                        "id": row_id,
+                        "label": label,
+                    }
+                    # Keys outside EXPECTED_KEYS were dropped by extrasaction="ignore" anyway
+                    for k, lc, rc in zip(EXPECTED_KEYS, LEFT_COLS, RIGHT_COLS):
+                        new_row[lc] = left_cleaned.get(k, "")
+                        new_row[rc] = right_cleaned.get(k, "")
+                    writer.writerow(new_row)
+                    next_i += 1
 
 
 def main() -> None:
@@ -1,4 +1,12 @@
 # walmart_llm_normalizer.py
+import asyncio
+import csv
+import hashlib
+import httpx
+import io
+import logging
+import sqlite3
+import sys
 import pandas as pd
 import ollama
 from tqdm import tqdm
@@ -6,15 +14,110 @@ import re
 import json
 from textwrap import dedent
 import os
-from typing import Dict, Any, Tuple, Optional
+from contextlib import nullcontext
+from itertools import groupby, islice
+from typing import Dict, Any, List, Set, Tuple, Optional
+
+# Per-reply diagnostics are DEBUG (run with --verbose to see them)
+log = logging.getLogger(__name__)
 
 # Walmart/Amazon record schema we want the LLM to output (per side)
 EXPECTED_KEYS = ["title", "category", "brand", "modelno", "price"]
 
+# Input columns read from each CSV; text fields are kept as strings so model
+# numbers like 49106 are not parsed into numbers, and prices stay numeric
+TEXT_KEYS = ["title", "category", "brand", "modelno"]
+INPUT_DTYPES = {f"{side}_{k}": str for side in ("left", "right") for k in TEXT_KEYS}
+INPUT_COLUMNS = frozenset(["id", "label", "left_price", "right_price", *INPUT_DTYPES])
+
+# Output tokens allowed per pair; one normalized left/right object is ~80-180 tokens
+NUM_PREDICT = 256
+# Stop at a closing code fence rather than letting the model ramble after the JSON
+STOP_SEQUENCES = ["\n```"]
+# Ollama's constrained-decoding mode for every request
+REPLY_FORMAT = "json"
+
+
+class PairCache:
+    """
+    Normalized (left, right) outputs keyed by a hash of the input pair, its label
+    (which picks the prompt), the model and the prompt version. Kept in memory and, when a path is
+    given, persisted to SQLite so repeated pairs across splits and reruns skip
+    the LLM entirely.
+    """
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self._mem: Dict[str, Tuple[Dict[str, Any], Dict[str, Any]]] = {}
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, isolation_level=None)
+            self._db.execute("CREATE TABLE IF NOT EXISTS pairs (key TEXT PRIMARY KEY, value TEXT)")
+
+    @staticmethod
+    def key(left: Dict[str, Any], right: Dict[str, Any], label: Optional[int], model: str, prompt_version: str) -> str:
+        payload = json.dumps([left, right, label, model, prompt_version], sort_keys=True).encode("utf-8")
+        return hashlib.blake2b(payload).hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[Dict[str, Any], Dict[str, Any]]]:
+        if key in self._mem:
+            return self._mem[key]
+        if self._db is not None:
+            row = self._db.execute("SELECT value FROM pairs WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                left, right = json.loads(row[0])
+                self._mem[key] = (left, right)
+                return left, right
+        return None
+
+    def set(self, key: str, value: Tuple[Dict[str, Any], Dict[str, Any]]) -> None:
+        self._mem[key] = value
+        if self._db is not None:
+            self._db.execute(
+                "INSERT OR REPLACE INTO pairs (key, value) VALUES (?, ?)",
+                (key, json.dumps(value, ensure_ascii=False)),
+            )
+
 
 class OllamaFeatureExtractor:
-    def __init__(self, model_name: str = "gemma3:12b") -> None:
+    def __init__(
+        self,
+        model_name: str = "gemma3:12b",
+        max_concurrency: Optional[int] = None,
+        keep_alive: str = "24h",
+        batch_size: int = 4,
+        use_cache: bool = True,
+        cache_path: Optional[str] = ".prompt_cache.sqlite",
+        host: Optional[str] = None,
+        timeout: float = 300,
+        shots: int = 2,
+    ) -> None:
         self.llm_model = model_name
+        # Server address (None falls back to OLLAMA_HOST) and per-request timeout
+        self.host = host
+        self.timeout = timeout
+        # Worked examples per prompt variant (at most 3); each one is prefill on every request
+        self.shots = shots
+        self._match_shots = self._format_shots(self._MATCH_SHOTS[:shots], "A")
+        self._nonmatch_shots = self._format_shots(self._NONMATCH_SHOTS[:shots], "B")
+        # Part of every cache key, so editing the prompts or options never reuses old answers
+        self.prompt_version = self._prompt_version()
+        # Successful pair outputs, keyed per prompt version so prompt edits start fresh
+        self.cache = PairCache(cache_path) if use_cache else None
+        # Consecutive same-label pairs sent per LLM call; 1 disables batching
+        self.batch_size = max(1, batch_size)
+        # Keep the model resident between requests and across splits; run the server
+        # with OLLAMA_MAX_LOADED_MODELS=1 so other models cannot evict it mid-job
+        self.keep_alive = keep_alive
+        # In-flight requests per dataset. Match the server's parallel slots: start
+        # `ollama serve` with OLLAMA_NUM_PARALLEL=N (and OLLAMA_MAX_LOADED_MODELS=1
+        # so all slots share one model); the same variable is read here by default.
+        if max_concurrency is None:
+            max_concurrency = int(os.environ.get("OLLAMA_NUM_PARALLEL", 8))
+        self.max_concurrency = max_concurrency
+        # Server slots for the current pass; every LLM request holds one while in flight
+        self._slots: Optional[asyncio.Semaphore] = None
+        # Pairs answered without the LLM in the current pass
+        self.fast_path_hits = 0
 
     # -------------------- Coercion & Validation (no manual normalization) --------------------
     def _coerce_price(self, value: Any) -> Any:
@@ -51,178 +154,361 @@ class OllamaFeatureExtractor:
         return out
 
     # -------------------- JSON extraction --------------------
-    def _extract_json(self, text: str) -> Dict[str, Any]:
-        """Robustly extract a single JSON object from the model output."""
+    def _extract_json(self, text: str) -> Any:
+        """Robustly extract a single JSON object (or batch array) from the model output."""
         if text.startswith("```"):
             text = re.sub(r"^```[a-zA-Z]*\n?", "", text)
             text = re.sub(r"```$", "", text).strip()
+        # Take the outermost JSON array or object, whichever opens first
         start = text.find("{")
-        end = text.rfind("}")
+        array_start = text.find("[")
+        if array_start != -1 and (start == -1 or array_start < start):
+            start, end = array_start, text.rfind("]")
+        else:
+            end = text.rfind("}")
         if start != -1 and end != -1 and end > start:
             text = text[start : end + 1]
         return json.loads(text)
 
+    def _is_trivial(self, record: Dict[str, Any]) -> bool:
+        """True when a record has no title, category, brand or model number."""
+        for key in TEXT_KEYS:
+            value = record.get(key)
+            if pd.notna(value) and str(value).strip():
+                return False
+        return True
+
     # -------------------- LLM prompts (Walmart dataset, Amazon-style brevity) --------------------
-    def _build_prompt_match(self, left: Dict[str, Any], right: Dict[str, Any]) -> str:
+    # Each prompt carries one or more pairs; with several, the shared rules and
+    # few-shot examples are sent once and the model answers with a "results" array
+    # in pair order.
+    # Rules and examples go in the system message and only the records in the user
+    # message, so consecutive requests share a byte-identical prefix that the server
+    # can keep in its KV cache instead of re-evaluating it.
+    def _return_instruction(self, n: int) -> str:
+        if n == 1:
+            return 'Return a SINGLE valid JSON object with exactly two top-level keys: "left" and "right".'
+        # format="json" only admits a top-level object, so the batch array is wrapped
+        return (
+            'Return a SINGLE valid JSON object with exactly one top-level key: "results". '
+            f'"results" is an array of exactly {n} objects, one per numbered pair [1]..[{n}], in order. '
+            'Each object in "results" has exactly two keys: "left" and "right".'
+        )
+
+    def _output_instruction(self, n: int) -> str:
+        if n == 1:
+            return "Return exactly one JSON object."
+        return f'Return exactly one JSON object whose "results" array holds {n} objects, in pair order.'
+
+    def _format_records(self, pairs: List[Tuple[Dict[str, Any], Dict[str, Any]]]) -> str:
+        # Compact, one line per record, the same layout as the few-shot inputs
+        def _pair(left: Dict[str, Any], right: Dict[str, Any]) -> str:
+            return (
+                f"Left record input:\n{json.dumps(left, ensure_ascii=False, separators=(',', ':'))}\n\n"
+                f"Right record input:\n{json.dumps(right, ensure_ascii=False, separators=(',', ':'))}\n"
+            )
+
+        if len(pairs) == 1:
+            return "Now process this record:\n\n" + _pair(*pairs[0])
+        blocks = [f"\n[{i}]\n" + _pair(left, right) for i, (left, right) in enumerate(pairs, 1)]
+        return f"Now process these {len(pairs)} record pairs:\n" + "".join(blocks)
+
+    # Worked examples, in the order they are kept when `shots` trims the list:
+    # the brand/category correction comes before the second like-for-like match
+    _MATCH_SHOTS = [
+        (
+            "HP Transfer Kit (match)",
+            dedent("""\
+                Left ⟶  {"title":"HP Q3675A Image Transfer Kit","category":"Printers","brand":"HP","modelno":"Q3675A","price":194.84}
+                Right ⟶ {"title":"Hewlett Packard Q3675A Image Transfer Kit For HP Color LaserJet 4650","category":"Cleaning & Repair","brand":"HP","modelno":"Q3675A","price":""}
+                Output
+                {
+                  "left":  {"title":"HP Q3675A Image Transfer Kit","category":"Printers","brand":"HP","modelno":"Q3675A","price":194.84},
+                  "right": {"title":"HP Q3675A Image Transfer Kit","category":"Printers","brand":"HP","modelno":"Q3675A","price":"unknown"}
+                }
+            """),
+        ),
+        (
+            "Balt Wheasel Easel (match; correct brand/category)",
+            dedent("""\
+                Left ⟶  {"title":"Balt Wheasel Easel Adjustable Melamine Dry Erase Board White","category":"Stationery & Office Machinery","brand":"Balt","modelno":"33250","price":239.88}
+                Right ⟶ {"title":"Balt Inc. Wheasel Easel Adjustable Melamine Dry Erase Board 28 3/4 X 59 1/2 White","category":"Laminating Supplies","brand":"Mayline","modelno":"","price":134.45}
+                Output
+                {
+                  "left":  {"title":"Balt Wheasel Easel Adjustable Melamine Dry Erase Board","category":"Stationery & Office Machinery","brand":"Balt","modelno":"33250","price":239.88},
+                  "right": {"title":"Balt Wheasel Easel Adjustable Melamine Dry Erase Board","category":"Stationery & Office Machinery","brand":"Balt","modelno":"","price":134.45}
+                }
+            """),
+        ),
+        (
+            "IOGEAR Bluetooth Micro Adapter (match)",
+            dedent("""\
+                Left ⟶  {"title":"IOGEAR GBU421W6 Bluetooth USB Micro Adapter","category":"Networking","brand":"IOGEAR","modelno":"GBU421W6","price":14.84}
+                Right ⟶ {"title":"IOGEAR Bluetooth USB 2.1 Micro Adapter With Tri-Language Package Black","category":"Computers & Accessories","brand":"IOGEAR","modelno":"GBU421W6","price":15.17}
+                Output
+                {
+                  "left":  {"title":"IOGEAR Bluetooth USB Micro Adapter","category":"Networking","brand":"IOGEAR","modelno":"GBU421W6","price":14.84},
+                  "right": {"title":"IOGEAR Bluetooth USB Micro Adapter","category":"Networking","brand":"IOGEAR","modelno":"GBU421W6","price":15.17}
+                }
+            """),
+        ),
+    ]
+
+    _MATCH_TEMPLATE = dedent("""
+    You are a product-normalization expert. Normalize and ALIGN two Walmart/Amazon product records for DeepMatcher.
+
+    {return_instruction}
+    Each side must follow this schema:
+      • "title" (string)
+      • "category" (string)
+      • "brand" (string)
+      • "modelno" (string)
+      • "price" (float or "unknown")
+
+    ALIGNMENT & NORMALIZATION FOR MATCHED PAIRS (label = 1)
+    - Titles: remove marketing fluff/tails; keep concrete identifiers (series, capacity, size/diagonal, edition, kit names).
+    - Casing/spacing: Title Case; collapse spaces; dedupe consecutive duplicate words.
+    - Brand: canonicalize to shortest unambiguous form shared by both sides (e.g., “Hewlett Packard” → “HP”).
+    - Category: prefer the most specific accurate category implied by both sides (e.g., “Projection Screens”, “USB Flash Drives”).
+    - Model number: extract the primary P/N or SKU; uppercase; keep A–Z/0–9 and -._/; drop color-only suffixes (e.g., “/ Navy”).
+    - Missing: empty fields → ""; price → float with two decimals if valid, else "unknown".
+    - Prices: NEVER fabricate/copy/average across sides.
+
+    {few_shots}OUTPUT RULES — STRICT
+    - {output_instruction}
+    - No code fences/markdown/comments/logs.
+    - Keys must be exactly: left.title, left.category, left.brand, left.modelno, left.price, right.title, right.category, right.brand, right.modelno, right.price.
+    - Price must be float (two decimals) or "unknown".
+
+    """)
+
+    def _build_prompt_match(self, pairs: List[Tuple[Dict[str, Any], Dict[str, Any]]]) -> Tuple[str, str]:
         """Prompt A — Label = 1 (MATCH): strong alignment-oriented normalization."""
-        return dedent(f"""
-        You are a product-normalization expert. Normalize and ALIGN two Walmart/Amazon product records for DeepMatcher.
-
-        Return a SINGLE valid JSON object with exactly two top-level keys: "left" and "right".
-        Each side must follow this schema:
-          • "title" (string)
-          • "category" (string)
-          • "brand" (string)
-          • "modelno" (string)
-          • "price" (float or "unknown")
-
-        ALIGNMENT & NORMALIZATION FOR MATCHED PAIRS (label = 1)
-        - Titles: remove marketing fluff/tails; keep concrete identifiers (series, capacity, size/diagonal, edition, kit names).
-        - Casing/spacing: Title Case; collapse spaces; dedupe consecutive duplicate words.
-        - Brand: canonicalize to shortest unambiguous form shared by both sides (e.g., “Hewlett Packard” → “HP”).
-        - Category: prefer the most specific accurate category implied by both sides (e.g., “Projection Screens”, “USB Flash Drives”).
-        - Model number: extract the primary P/N or SKU; uppercase; keep A–Z/0–9 and -._/; drop color-only suffixes (e.g., “/ Navy”).
-        - Missing: empty fields → ""; price → float with two decimals if valid, else "unknown".
-        - Prices: NEVER fabricate/copy/average across sides.
-
-        FEW-SHOT EXAMPLES
-        A1. HP Transfer Kit (match)
-        Left ⟶  {{"title":"HP Q3675A Image Transfer Kit","category":"Printers","brand":"HP","modelno":"Q3675A","price":194.84}}
-        Right ⟶ {{"title":"Hewlett Packard Q3675A Image Transfer Kit For HP Color LaserJet 4650","category":"Cleaning & Repair","brand":"HP","modelno":"Q3675A","price":""}}
-        Output
-        {{
-          "left":  {{"title":"HP Q3675A Image Transfer Kit","category":"Printers","brand":"HP","modelno":"Q3675A","price":194.84}},
-          "right": {{"title":"HP Q3675A Image Transfer Kit","category":"Printers","brand":"HP","modelno":"Q3675A","price":"unknown"}}
-        }}
-
-        A2. IOGEAR Bluetooth Micro Adapter (match)
-        Left ⟶  {{"title":"IOGEAR GBU421W6 Bluetooth USB Micro Adapter","category":"Networking","brand":"IOGEAR","modelno":"GBU421W6","price":14.84}}
-        Right ⟶ {{"title":"IOGEAR Bluetooth USB 2.1 Micro Adapter With Tri-Language Package Black","category":"Computers & Accessories","brand":"IOGEAR","modelno":"GBU421W6","price":15.17}}
-        Output
-        {{
-          "left":  {{"title":"IOGEAR Bluetooth USB Micro Adapter","category":"Networking","brand":"IOGEAR","modelno":"GBU421W6","price":14.84}},
-          "right": {{"title":"IOGEAR Bluetooth USB Micro Adapter","category":"Networking","brand":"IOGEAR","modelno":"GBU421W6","price":15.17}}
-        }}
-
-        A3. Balt Wheasel Easel (match; correct brand/category)
-        Left ⟶  {{"title":"Balt Wheasel Easel Adjustable Melamine Dry Erase Board White","category":"Stationery & Office Machinery","brand":"Balt","modelno":"33250","price":239.88}}
-        Right ⟶ {{"title":"Balt Inc. Wheasel Easel Adjustable Melamine Dry Erase Board 28 3/4 X 59 1/2 White","category":"Laminating Supplies","brand":"Mayline","modelno":"","price":134.45}}
-        Output
-        {{
-          "left":  {{"title":"Balt Wheasel Easel Adjustable Melamine Dry Erase Board","category":"Stationery & Office Machinery","brand":"Balt","modelno":"33250","price":239.88}},
-          "right": {{"title":"Balt Wheasel Easel Adjustable Melamine Dry Erase Board","category":"Stationery & Office Machinery","brand":"Balt","modelno":"","price":134.45}}
-        }}
-
-        OUTPUT RULES — STRICT
-        - Return exactly one JSON object.
-        - No code fences/markdown/comments/logs.
-        - Keys must be exactly: left.title, left.category, left.brand, left.modelno, left.price, right.title, right.category, right.brand, right.modelno, right.price.
-        - Price must be float (two decimals) or "unknown".
-
-        Now process this record:
-
-        Left record input:
-        {json.dumps(left, ensure_ascii=False, indent=2)}
-
-        Right record input:
-        {json.dumps(right, ensure_ascii=False, indent=2)}
-        """)
-
-    def _build_prompt_nonmatch(self, left: Dict[str, Any], right: Dict[str, Any]) -> str:
+        n = len(pairs)
+        return self._MATCH_TEMPLATE.format(
+            return_instruction=self._return_instruction(n),
+            few_shots=self._match_shots,
+            output_instruction=self._output_instruction(n),
+        ), self._format_records(pairs)
+
+    # Worked examples, in the order they are kept when `shots` trims the list:
+    # the same-brand pair comes before the cross-brand GPUs
+    _NONMATCH_SHOTS = [
+        (
+            "SD Cards (non-match)",
+            dedent("""\
+                Left ⟶  {"title":"Sony 16GB Class 4 SD Memory Card","category":"USB Drives","brand":"Sony","modelno":"SF16N4/TQP","price":0.0}
+                Right ⟶ {"title":"PNY 4GB Class 4 Navy SD Card","category":"Car Audio Video","brand":"PNY","modelno":"P-SDHC4G4-EF / Navy","price":11.18}
+                Output
+                {
+                  "left":  {"title":"Sony 16Gb Class 4 SD Memory Card","category":"USB Drives","brand":"Sony","modelno":"SF16N4/TQP","price":0.00},
+                  "right": {"title":"PNY 4Gb Class 4 SD Card","category":"Car Audio Video","brand":"PNY","modelno":"P-SDHC4G4-EF","price":11.18}
+                }
+            """),
+        ),
+        (
+            "USB Flash (non-match)",
+            dedent("""\
+                Left ⟶  {"title":"Verbatim 4GB Tuff - N - Tiny USB 2.0 Flash Drive Green","category":"USB Drives","brand":"Verbatim","modelno":"","price":11.98}
+                Right ⟶ {"title":"Verbatim Clip-It 4 GB USB 2.0 Flash Drive 97556 Green","category":"USB Flash Drives","brand":"Verbatim","modelno":"97556","price":10.98}
+                Output
+                {
+                  "left":  {"title":"Verbatim 4Gb Tuff-N-Tiny USB 2.0 Flash Drive Green","category":"USB Drives","brand":"Verbatim","modelno":"","price":11.98},
+                  "right": {"title":"Verbatim Clip-It 4 Gb USB 2.0 Flash Drive 97556 Green","category":"USB Flash Drives","brand":"Verbatim","modelno":"97556","price":10.98}
+                }
+            """),
+        ),
+        (
+            "GPUs (non-match)",
+            dedent("""\
+                Left ⟶  {"title":"ZOTAC GeForce GT430 1GB DDR3 PCI-Express 2.0 Graphics Card","category":"Electronics - General","brand":"ZOTAC","modelno":"ZT-40604-10L","price":88.88}
+                Right ⟶ {"title":"EVGA GeForce GTS450 Superclocked 1 GB GDDR5 PCI-Express 2.0 Graphics Card 01G-P3-1452-TR","category":"Graphics Cards","brand":"EVGA","modelno":"01G-P3-1452-TR","price":119.88}
+                Output
+                {
+                  "left":  {"title":"Zotac GeForce GT430 1Gb Ddr3 PCI-Express 2.0 Graphics Card","category":"Electronics - General","brand":"ZOTAC","modelno":"ZT-40604-10L","price":88.88},
+                  "right": {"title":"EVGA GeForce GTS450 Superclocked 1 Gb Gddr5 PCI-Express 2.0 Graphics Card","category":"Graphics Cards","brand":"EVGA","modelno":"01G-P3-1452-TR","price":119.88}
+                }
+            """),
+        ),
+    ]
+
+    _NONMATCH_TEMPLATE = dedent("""
+    You are a product-normalization expert. Lightly CLEAN two Walmart/Amazon product records for DeepMatcher WITHOUT aligning them. Preserve discriminative tokens and cues.
+
+    {return_instruction}
+    Each side must follow this schema:
+      • "title" (string)
+      • "category" (string)
+      • "brand" (string)
+      • "modelno" (string)
+      • "price" (float or "unknown")
+
+    LIGHT NORMALIZATION FOR NON-MATCHED PAIRS (label = 0)
+    - Titles: keep platform/spec/marketing descriptors; only fix casing/punctuation and duplicate spaces.
+    - Do NOT copy tokens (capacity, series, edition) across sides.
+    - Brand: shorten obvious suffixes (Inc., Ltd., Corp.) when unambiguous; do NOT force two brands to match.
+    - Category: minor cleanup (Title Case); keep as-is unless a more specific, unambiguous category is obvious.
+    - Model number: per side independently; uppercase; keep A–Z/0–9 and -._/; strip color-only suffixes (e.g., “/ Navy”) if clearly color.
+    - Missing: empty fields → ""; price → float with two decimals if valid, else "unknown".
+    - Prices: NEVER fabricate.
+
+    {few_shots}OUTPUT RULES — STRICT
+    - {output_instruction}
+    - No code fences/markdown/comments/logs.
+    - Keys must be exactly: left.title, left.category, left.brand, left.modelno, left.price, right.title, right.category, right.brand, right.modelno, right.price.
+    - Price must be float (two decimals) or "unknown".
+
+    """)
+
+    def _build_prompt_nonmatch(self, pairs: List[Tuple[Dict[str, Any], Dict[str, Any]]]) -> Tuple[str, str]:
         """Prompt B — Label = 0 (NON-MATCH): light, conservative cleanup without alignment."""
-        return dedent(f"""
-        You are a product-normalization expert. Lightly CLEAN two Walmart/Amazon product records for DeepMatcher WITHOUT aligning them. Preserve discriminative tokens and cues.
-
-        Return a SINGLE valid JSON object with exactly two top-level keys: "left" and "right".
-        Each side must follow this schema:
-          • "title" (string)
-          • "category" (string)
-          • "brand" (string)
-          • "modelno" (string)
-          • "price" (float or "unknown")
-
-        LIGHT NORMALIZATION FOR NON-MATCHED PAIRS (label = 0)
-        - Titles: keep platform/spec/marketing descriptors; only fix casing/punctuation and duplicate spaces.
-        - Do NOT copy tokens (capacity, series, edition) across sides.
-        - Brand: shorten obvious suffixes (Inc., Ltd., Corp.) when unambiguous; do NOT force two brands to match.
-        - Category: minor cleanup (Title Case); keep as-is unless a more specific, unambiguous category is obvious.
-        - Model number: per side independently; uppercase; keep A–Z/0–9 and -._/; strip color-only suffixes (e.g., “/ Navy”) if clearly color.
-        - Missing: empty fields → ""; price → float with two decimals if valid, else "unknown".
-        - Prices: NEVER fabricate.
-
-        FEW-SHOT EXAMPLES
-        B1. SD Cards (non-match)
-        Left ⟶  {{"title":"Sony 16GB Class 4 SD Memory Card","category":"USB Drives","brand":"Sony","modelno":"SF16N4/TQP","price":0.0}}
-        Right ⟶ {{"title":"PNY 4GB Class 4 Navy SD Card","category":"Car Audio Video","brand":"PNY","modelno":"P-SDHC4G4-EF / Navy","price":11.18}}
-        Output
-        {{
-          "left":  {{"title":"Sony 16Gb Class 4 SD Memory Card","category":"USB Drives","brand":"Sony","modelno":"SF16N4/TQP","price":0.00}},
-          "right": {{"title":"PNY 4Gb Class 4 SD Card","category":"Car Audio Video","brand":"PNY","modelno":"P-SDHC4G4-EF","price":11.18}}
-        }}
-
-        B2. GPUs (non-match)
-        Left ⟶  {{"title":"ZOTAC GeForce GT430 1GB DDR3 PCI-Express 2.0 Graphics Card","category":"Electronics - General","brand":"ZOTAC","modelno":"ZT-40604-10L","price":88.88}}
-        Right ⟶ {{"title":"EVGA GeForce GTS450 Superclocked 1 GB GDDR5 PCI-Express 2.0 Graphics Card 01G-P3-1452-TR","category":"Graphics Cards","brand":"EVGA","modelno":"01G-P3-1452-TR","price":119.88}}
-        Output
-        {{
-          "left":  {{"title":"Zotac GeForce GT430 1Gb Ddr3 PCI-Express 2.0 Graphics Card","category":"Electronics - General","brand":"ZOTAC","modelno":"ZT-40604-10L","price":88.88}},
-          "right": {{"title":"EVGA GeForce GTS450 Superclocked 1 Gb Gddr5 PCI-Express 2.0 Graphics Card","category":"Graphics Cards","brand":"EVGA","modelno":"01G-P3-1452-TR","price":119.88}}
-        }}
-
-        B3. USB Flash (non-match)
-        Left ⟶  {{"title":"Verbatim 4GB Tuff - N - Tiny USB 2.0 Flash Drive Green","category":"USB Drives","brand":"Verbatim","modelno":"","price":11.98}}
-        Right ⟶ {{"title":"Verbatim Clip-It 4 GB USB 2.0 Flash Drive 97556 Green","category":"USB Flash Drives","brand":"Verbatim","modelno":"97556","price":10.98}}
-        Output
-        {{
-          "left":  {{"title":"Verbatim 4Gb Tuff-N-Tiny USB 2.0 Flash Drive Green","category":"USB Drives","brand":"Verbatim","modelno":"","price":11.98}},
-          "right": {{"title":"Verbatim Clip-It 4 Gb USB 2.0 Flash Drive 97556 Green","category":"USB Flash Drives","brand":"Verbatim","modelno":"97556","price":10.98}}
-        }}
-
-        OUTPUT RULES — STRICT
-        - Return exactly one JSON object.
-        - No code fences/markdown/comments/logs.
-        - Keys must be exactly: left.title, left.category, left.brand, left.modelno, left.price, right.title, right.category, right.brand, right.modelno, right.price.
-        - Price must be float (two decimals) or "unknown".
-
-        Now process this record:
-
-        Left record input:
-        {json.dumps(left, ensure_ascii=False, indent=2)}
-
-        Right record input:
-        {json.dumps(right, ensure_ascii=False, indent=2)}
-        """)
+        n = len(pairs)
+        return self._NONMATCH_TEMPLATE.format(
+            return_instruction=self._return_instruction(n),
+            few_shots=self._nonmatch_shots,
+            output_instruction=self._output_instruction(n),
+        ), self._format_records(pairs)
+
+    def _format_shots(self, examples: List[Tuple[str, str]], tag: str) -> str:
+        """The FEW-SHOT EXAMPLES block, or nothing when no examples are kept."""
+        if not examples:
+            return ""
+        worked = "".join(f"{tag}{i}. {title}\n{example}\n" for i, (title, example) in enumerate(examples, 1))
+        return "FEW-SHOT EXAMPLES\n" + worked
+
+    def _build_prompt(
+        self, pairs: List[Tuple[Dict[str, Any], Dict[str, Any]]], label: Optional[int]
+    ) -> Tuple[str, str]:
+        """Return (instructions, records) for the system and user messages."""
+        if label == 1:
+            return self._build_prompt_match(pairs)
+        return self._build_prompt_nonmatch(pairs)
 
     # -------------------- LLM call --------------------
-    def _chat_json(self, prompt: str) -> Dict[str, Any]:
-        response = ollama.chat(
-            model=self.llm_model,
-            options={"temperature": 0.0, "num_predict": 1024},
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "You are a careful information extractor. Output only valid JSON. "
-                        "Do not include explanations, markdown fences, comments, or extra text. "
-                        "Return exactly one JSON object conforming to the requested schema."
-                    ),
-                },
-                {"role": "user", "content": prompt},
-            ],
-        )
+    def preload_model(self) -> None:
+        """Load the model once up front so the first split does not pay the cold start."""
+        try:
+            ollama.Client(host=self.host, timeout=self.timeout).generate(
+                model=self.llm_model, prompt="", keep_alive=self.keep_alive
+            )
+        except Exception as e:
+            log.warning("⚠️  Could not preload %s: %s", self.llm_model, e)
+
+    _SYSTEM_GUARD = (
+        "You are a careful information extractor. Output only valid JSON. "
+        "Do not include explanations, markdown fences, comments, or extra text. "
+        "Return exactly one JSON object conforming to the requested schema.\n"
+    )
+
+    def _options(self, n_pairs: int) -> Dict[str, Any]:
+        # Budget sized to the pairs in the request, so a rambling reply is cut short.
+        # A fixed num_ctx keeps every request on the same loaded context.
+        return {
+            "temperature": 0.0,
+            "num_predict": NUM_PREDICT * n_pairs,
+            "num_ctx": 4096,
+            "stop": STOP_SEQUENCES,
+        }
+
+    def _prompt_version(self) -> str:
+        """
+        Hash of everything besides the records that shapes a reply: the system
+        prompts for single and batched requests, the record layout, the options
+        and the reply format.
+        """
+        probe = dict.fromkeys(EXPECTED_KEYS, "")
+        prompts = [self._build_prompt([(probe, probe)] * n, label) for label in (0, 1) for n in (1, 2)]
+        payload = json.dumps([self._SYSTEM_GUARD, prompts, self._options(1), REPLY_FORMAT], sort_keys=True)
+        return hashlib.blake2b(payload.encode("utf-8")).hexdigest()
+
+    async def _chat_json(
+        self, client: ollama.AsyncClient, instructions: str, records: str, n_pairs: int = 1
+    ) -> Any:
+        # format="json" makes the server constrain decoding to a valid JSON object
+        # One slot per request, so per-pair retries count against max_concurrency too
+        async with self._slots or nullcontext():
+            response = await client.chat(
+                model=self.llm_model,
+                format=REPLY_FORMAT,
+                keep_alive=self.keep_alive,
+                options=self._options(n_pairs),
+                messages=[
+                    {"role": "system", "content": self._SYSTEM_GUARD + instructions},
+                    {"role": "user", "content": records},
+                ],
+            )
         content = response["message"]["content"].strip()
-        
-        print("passed",content)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("passed: %s", content)
         try:
-            return self._extract_json(content)
+            return self._parse_reply(content)
         except json.JSONDecodeError as jde:
-            print(f"❌ JSON decode error: {jde}")
-            print("⚠️ Content that failed parsing:", content)
+            log.warning("❌ JSON decode error: %s", jde)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Content that failed parsing: %s", content)
             raise
 
+    def _parse_reply(self, content: str) -> Any:
+        """Constrained replies are plain JSON; _extract_json stays as defense in depth."""
+        try:
+            return json.loads(content)
+        except json.JSONDecodeError:
+            return self._extract_json(content)
+
     # -------------------- Main extraction API --------------------
-    def extract_pair_standardized_attributes(
+    async def _extract_pair_llm(
+        self,
+        client: ollama.AsyncClient,
+        left_record: Dict[str, Any],
+        right_record: Dict[str, Any],
+        label: Optional[int] = None,
+    ) -> Optional[Tuple[Dict[str, Any], Dict[str, Any]]]:
+        """One LLM call for one pair; None when the reply cannot be used."""
+        instructions, records = self._build_prompt([(left_record, right_record)], label)
+
+        try:
+            parsed = await self._chat_json(client, instructions, records)
+            left_out = self.normalize_llm_output(parsed.get("left", {}))
+            right_out = self.normalize_llm_output(parsed.get("right", {}))
+            return left_out, right_out
+        except Exception as e:
+            log.warning("❌ Extraction error: %s", e)
+            return None
+
+    async def _extract_batch_llm(
         self,
+        client: ollama.AsyncClient,
+        pairs: List[Tuple[Dict[str, Any], Dict[str, Any]]],
+        label: Optional[int] = None,
+    ) -> List[Optional[Tuple[Dict[str, Any], Dict[str, Any]]]]:
+        """One LLM call for all pairs; a malformed batch answer falls back to one call per pair."""
+        if len(pairs) == 1:
+            left_record, right_record = pairs[0]
+            return [await self._extract_pair_llm(client, left_record, right_record, label)]
+
+        instructions, records = self._build_prompt(pairs, label)
+        try:
+            parsed = await self._chat_json(client, instructions, records, n_pairs=len(pairs))
+            if isinstance(parsed, dict):
+                parsed = parsed.get("results")
+            if not isinstance(parsed, list) or len(parsed) != len(pairs):
+                raise ValueError(f"expected a results array of {len(pairs)} objects")
+            return [
+                (self.normalize_llm_output(item.get("left", {})), self.normalize_llm_output(item.get("right", {})))
+                for item in parsed
+            ]
+        except Exception as e:
+            log.warning("❌ Batch extraction error: %s; retrying %d pairs one by one", e, len(pairs))
+            # Start every retry before waiting on any; each waits for its own server slot
+            return list(
+                await asyncio.gather(
+                    *(self._extract_pair_llm(client, left_record, right_record, label) for left_record, right_record in pairs)
+                )
+            )
+
+    async def extract_pair_standardized_attributes(
+        self,
+        client: ollama.AsyncClient,
         left_record: Dict[str, Any],
         right_record: Dict[str, Any],
         label: Optional[int] = None,
@@ -233,80 +519,194 @@ class OllamaFeatureExtractor:
           - label == 0 or None → conservative cleanup (non-match)
         All domain logic is inside the prompt; Python only coerces types.
         """
-        if label == 1:
-            prompt = self._build_prompt_match(left_record, right_record)
-        else:
-            prompt = self._build_prompt_nonmatch(left_record, right_record)
+        return (await self.extract_batch_standardized_attributes(client, [(left_record, right_record)], label))[0]
 
-        try:
-            parsed = self._chat_json(prompt)
-            left_out = self.normalize_llm_output(parsed.get("left", {}))
-            right_out = self.normalize_llm_output(parsed.get("right", {}))
-            return left_out, right_out
-        except Exception as e:
-            print(f"❌ Extraction error: {e}")
-            # Fallback: minimally cleaned originals (no domain normalization)
-            return self.normalize_llm_output(left_record), self.normalize_llm_output(right_record)
+    async def extract_batch_standardized_attributes(
+        self,
+        client: ollama.AsyncClient,
+        pairs: List[Tuple[Dict[str, Any], Dict[str, Any]]],
+        label: Optional[int] = None,
+    ) -> List[Tuple[Dict[str, Any], Dict[str, Any]]]:
+        """
+        Normalize several same-label pairs with one LLM call. Empty and cached
+        pairs skip the LLM; pairs that fail fall back to their minimally cleaned
+        originals, which are not cached.
+        """
+        results: List[Optional[Tuple[Dict[str, Any], Dict[str, Any]]]] = [None] * len(pairs)
+        keys: List[Optional[str]] = [None] * len(pairs)
+        misses = []
+        for i, (left_record, right_record) in enumerate(pairs):
+            if self._is_trivial(left_record) and self._is_trivial(right_record):
+                # Deterministic fast path: missing cells become ""/"unknown", as the prompt asks of the LLM
+                results[i] = (
+                    self.normalize_llm_output({k: v for k, v in left_record.items() if pd.notna(v)}),
+                    self.normalize_llm_output({k: v for k, v in right_record.items() if pd.notna(v)}),
+                )
+                self.fast_path_hits += 1
+                continue
+            if self.cache is not None:
+                keys[i] = PairCache.key(left_record, right_record, label, self.llm_model, self.prompt_version)
+                results[i] = self.cache.get(keys[i])
+            if results[i] is None:
+                misses.append(i)
+
+        if misses:
+            cleaned = await self._extract_batch_llm(client, [pairs[i] for i in misses], label)
+            for i, pair_out in zip(misses, cleaned):
+                if pair_out is None:
+                    # Fallback: minimally cleaned originals (no domain normalization)
+                    left_record, right_record = pairs[i]
+                    pair_out = (self.normalize_llm_output(left_record), self.normalize_llm_output(right_record))
+                elif keys[i] is not None:
+                    self.cache.set(keys[i], pair_out)
+                results[i] = pair_out
+        return results
 
     # -------------------- Dataset utilities --------------------
-    def split_record(self, row: Dict[str, Any], side: str) -> Dict[str, Any]:
+    def side_records(self, df: pd.DataFrame, side: str) -> List[Dict[str, Any]]:
         """
         Map CSV columns:
           left_title,right_title,left_category,right_category,left_brand,right_brand,left_modelno,right_modelno,left_price,right_price
         into per-side dicts with keys: title, category, brand, modelno, price
+        One pandas pass per side; a column missing from the CSV comes back as NaN.
         """
-        return {
-            "title": row.get(f"{side}_title"),
-            "category": row.get(f"{side}_category"),
-            "brand": row.get(f"{side}_brand"),
-            "modelno": row.get(f"{side}_modelno"),
-            "price": row.get(f"{side}_price"),
-        }
+        cols = [f"{side}_{k}" for k in EXPECTED_KEYS]
+        return df.reindex(columns=cols).set_axis(EXPECTED_KEYS, axis=1).to_dict("records")
 
-    def process_dataset(self, input_csv: str, output_csv: str) -> None:
+    def _output_row(
+        self,
+        row_id: Any,
+        raw_label: Any,
+        left_cleaned: Dict[str, Any],
+        right_cleaned: Dict[str, Any],
+    ) -> Dict[str, Any]:
+        new_row: Dict[str, Any] = {
+            "id": row_id,
+            # pandas wrote missing labels as empty cells
+            "label": None if isinstance(raw_label, float) and raw_label != raw_label else raw_label,
+        }
+        # NaN prices are written as empty cells, as DataFrame.to_csv did
+        for k, v in left_cleaned.items():
+            new_row[f"left_{k}"] = None if isinstance(v, float) and v != v else v
+        for k, v in right_cleaned.items():
+            new_row[f"right_{k}"] = None if isinstance(v, float) and v != v else v
+        return new_row
+
+    def _written_ids(self, output_csv: str, fieldnames: List[str]) -> Optional[Set[str]]:
+        """
+        Ids already present in an earlier (possibly interrupted) output with the
+        same header, or None when there is nothing to resume from.
+        """
+        if not os.path.exists(output_csv):
+            return None
+        with open(output_csv, "r+", newline="", encoding="utf-8") as f:
+            data = f.read()
+            # Drop a partial last row left behind by an interrupted write
+            complete = data[: data.rfind("\n") + 1]
+            if complete != data:
+                f.seek(0)
+                f.write(complete)
+                f.truncate()
+        rows = list(csv.reader(io.StringIO(complete)))
+        if not rows or rows[0] != fieldnames:
+            return None
+        return {row[0] for row in rows[1:] if row}
+
+    def process_dataset(self, input_csv: str, output_csv: str, resume: bool = True) -> None:
+        asyncio.run(self._process_dataset(input_csv, output_csv, resume))
+
+    async def _process_dataset(self, input_csv: str, output_csv: str, resume: bool = True) -> None:
         print(f"📄 Reading data from {input_csv}...")
-        df = pd.read_csv(input_csv)
-        all_rows = []
-
-        for _, row in tqdm(df.iterrows(), total=len(df)):
-            row_dict = row.to_dict()
-            left_input = self.split_record(row_dict, "left")
-            right_input = self.split_record(row_dict, "right")
-
-            raw_label = row_dict.get("label", None)
+        # Only the columns the pipeline uses are parsed; a missing one is not an error
+        df = pd.read_csv(input_csv, usecols=lambda col: col in INPUT_COLUMNS, dtype=INPUT_DTYPES)
+
+        fieldnames = ["id", "label"] + [f"left_{k}" for k in EXPECTED_KEYS] + [f"right_{k}" for k in EXPECTED_KEYS]
+        done = self._written_ids(output_csv, fieldnames) if resume else None
+        if done is not None:
+            print(f"↩️  Resuming {output_csv}: {len(done)} rows already written")
+
+        # Created here because a semaphore is bound to this pass's event loop
+        self._slots = asyncio.Semaphore(self.max_concurrency)
+
+        # Each side is sliced and converted in one pass instead of per row
+        missing = [None] * len(df)
+        rows = []
+        for row_id, raw_label, left_input, right_input in zip(
+            df["id"].tolist() if "id" in df.columns else missing,
+            df["label"].tolist() if "label" in df.columns else missing,
+            self.side_records(df, "left"),
+            self.side_records(df, "right"),
+        ):
+            if done and str(row_id) in done:
+                continue
             try:
                 label_val: Optional[int] = int(raw_label) if pd.notna(raw_label) else None
             except Exception:
                 label_val = None
-
-            left_cleaned, right_cleaned = self.extract_pair_standardized_attributes(
-                left_input, right_input, label=label_val
-            )
-
-            new_row: Dict[str, Any] = {
-                "id": row_dict.get("id"),
-                "label": raw_label,
-            }
-            for k, v in left_cleaned.items():
-                new_row[f"left_{k}"] = v
-            for k, v in right_cleaned.items():
-                new_row[f"right_{k}"] = v
-            all_rows.append(new_row)
-
-        enriched_df = pd.DataFrame(all_rows)
-        print(f"💾 Saving enriched data to {output_csv}")
-        enriched_df.to_csv(output_csv, index=False)
+            rows.append((row_id, raw_label, label_val, left_input, right_input))
+        progress = tqdm(total=len(rows))
+        self.fast_path_hits = 0
+
+        async def _bounded(batch: List[Tuple[Any, Any, Optional[int], Dict[str, Any], Dict[str, Any]]]) -> List[Tuple[Dict[str, Any], Dict[str, Any]]]:
+            pairs = [(left_input, right_input) for _, _, _, left_input, right_input in batch]
+            cleaned = await self.extract_batch_standardized_attributes(client, pairs, label=batch[0][2])
+            progress.update(len(batch))
+            return cleaned
+
+        # Runs of consecutive same-label rows, cut into batches of at most batch_size
+        batches = []
+        for _, run in groupby(rows, key=lambda r: r[2]):
+            while True:
+                batch = list(islice(run, self.batch_size))
+                if not batch:
+                    break
+                batches.append(batch)
+
+        print(f"💾 Streaming enriched data to {output_csv}")
+        # One client, and so one keep-alive connection pool, serves the whole pass.
+        # It is bound to this event loop, so it is closed when the pass ends.
+        # _slots already bounds the requests in flight, so the connection cap only has
+        # to stay out of its way: httpx's default of 100, or more for a larger
+        # max_concurrency. The idle keep-alive limit is raised from httpx's 20 so that
+        # concurrency above 20 reuses open connections instead of reconnecting.
+        limits = httpx.Limits(
+            max_connections=max(self.max_concurrency, 100),
+            max_keepalive_connections=max(self.max_concurrency, 20),
+        )
+        async with ollama.AsyncClient(host=self.host, timeout=self.timeout, limits=limits) as client:
+            with open(output_csv, "a" if done is not None else "w", newline="", encoding="utf-8") as f:
+                writer = csv.DictWriter(f, fieldnames=fieldnames, restval="", extrasaction="ignore", lineterminator="\n")
+                if done is None:
+                    writer.writeheader()
+                # All batches run concurrently; rows are written in CSV order as their batch finishes
+                tasks = [asyncio.create_task(_bounded(batch)) for batch in batches]
+                for batch, task in zip(batches, tasks):
+                    if not task.done():
+                        # Flush before waiting so an interrupted run stays resumable
+                        f.flush()
+                    for (row_id, raw_label, _, _, _), (left_cleaned, right_cleaned) in zip(batch, await task):
+                        writer.writerow(self._output_row(row_id, raw_label, left_cleaned, right_cleaned))
+        progress.close()
+        if self.fast_path_hits:
+            print(f"⚡ {self.fast_path_hits} empty pairs skipped the LLM")
 
 
 def main() -> None:
+    logging.basicConfig(
+        level=logging.DEBUG if "--verbose" in sys.argv[1:] else logging.WARNING,
+        format="%(message)s",
+    )
+    # httpx logs every request at INFO; keep it quiet even under --verbose
+    logging.getLogger("httpx").setLevel(logging.WARNING)
     extractor = OllamaFeatureExtractor(model_name="llama3.1")
+    extractor.preload_model()
 
     for split in ["train", "valid", "test"]:
         input_file = f"{split}.csv"
         output_file = f"{split}_enriched.csv"
         if os.path.exists(input_file):
             print(f"\n🟡 Processing {split}...")
-            extractor.process_dataset(input_file, output_file)
+            extractor.process_dataset(input_file, output_file, resume="--no-resume" not in sys.argv[1:])
         else:
             print(f"⚠️  {input_file} not found, skipping...")
 